@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :metrics_api.py
+# @时间       :2024/2/2 上午11:20
+# @作者       :lihb
+# @说明       : Prometheus 指标接口
+
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from core.metrics import CONTENT_TYPE, metrics
+
+router = APIRouter(tags=['metrics'])
+
+
+@router.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    """Prometheus 文本格式的指标，汇总同主机所有 worker 的计数"""
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
@@ -5,11 +5,22 @@
 # @作者       :lihb
 # @说明       :
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from starlette.responses import StreamingResponse
+
+from models.qianfan import QianFanRequest
 
 router = APIRouter(prefix='/openai_gpt', tags=['openai Gpt'])
 
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    # 关闭 nginx 的响应缓冲，每个 token 生成后立即发给客户端
+    'X-Accel-Buffering': 'no',
+}
+
 
-@router.post('/')
-def get_():
-    pass
+@router.post('/', response_class=StreamingResponse)
+async def chat(request: Request, body: QianFanRequest):
+    """流式对话，以 SSE 的形式原样转发千帆返回的数据，客户端断开时取消上游请求"""
+    stream = await request.app.state.qianfan.stream_chat(body)
+    return StreamingResponse(stream, media_type='text/event-stream', headers=SSE_HEADERS)
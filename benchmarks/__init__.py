@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :__init__.py
+# @时间       :2024/1/15 上午10:05
+# @作者       :lihb
+# @说明       : 性能测试脚本，使用 python -m benchmarks.xxx 运行
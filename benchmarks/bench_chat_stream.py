@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_chat_stream.py
+# @时间       :2024/1/24 下午3:00
+# @作者       :lihb
+# @说明       : 流式对话接口压测，对接本地模拟的千帆服务，统计首字节时间（TTFB）和并发流数
+#               python -m benchmarks.bench_chat_stream --streams 200
+import asyncio
+import statistics
+from collections import Counter
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+import httpx
+import typer
+import uvicorn
+from fastapi import FastAPI
+from loguru import logger
+
+from api import openai_gpt_api
+from benchmarks.fake_qianfan import create_app as create_fake_app
+from core.config import settings
+from core.qianfan import QianFanClient
+
+FAKE_PORT = 18900
+PROXY_PORT = 18901
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # 只初始化千帆客户端，不连接nacos
+    app.state.qianfan = QianFanClient()
+    yield
+    await app.state.qianfan.close()
+
+
+def _serve(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def _measure(streams: int):
+    limits = httpx.Limits(max_connections=streams)
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{PROXY_PORT}', limits=limits, timeout=60) as client:
+
+        async def one(i: int) -> tuple[int, float, float]:
+            start = time.perf_counter()
+            ttfb = None
+            async with client.stream('POST', '/openai_gpt/', json={'content': f'问题{i}'}) as res:
+                async for _ in res.aiter_raw():
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - start
+            return res.status_code, ttfb, time.perf_counter() - start
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(one(i) for i in range(streams)))
+        elapsed = time.perf_counter() - start
+        # 429 等失败的请求不计入耗时统计
+        results = [(ttfb, total) for status, ttfb, total in responses if status == 200]
+        failed = Counter(status for status, _, _ in responses if status != 200)
+        print(f'并发流 {streams}，成功 {len(results)}，失败 {dict(failed)}，总耗时 {elapsed:.2f}s')
+        if not results:
+            return
+        ttfbs = sorted(r[0] for r in results)
+        print(f'TTFB  p50 {statistics.median(ttfbs) * 1000:.1f}ms  '
+              f'p99 {ttfbs[max(int(len(ttfbs) * 0.99) - 1, 0)] * 1000:.1f}ms')
+        print(f'完整响应 p50 {statistics.median(r[1] for r in results) * 1000:.1f}ms')
+
+        # 客户端读到第一段数据后断开，上游的流应该被取消
+        async with client.stream('POST', '/openai_gpt/', json={'content': '断开'}) as res:
+            async for _ in res.aiter_raw():
+                break
+        await asyncio.sleep(0.5)
+
+
+def run(streams: Annotated[int, typer.Option(help='同时进行的流式对话数')] = 200,
+        tokens: Annotated[int, typer.Option(help='每次对话返回的 token 数')] = 20,
+        first_delay: Annotated[float, typer.Option(help='模拟的首字延迟（秒）')] = 0.2,
+        qps: Annotated[float, typer.Option(help='千帆配额，默认不让配额成为瓶颈，调小可以观察排队和 429')] = 10000):
+    logger.remove()
+    fake_app = create_fake_app(tokens=tokens, first_delay=first_delay)
+    _serve(fake_app, FAKE_PORT)
+    settings.update_data({'qianfan': {'base_url': f'http://127.0.0.1:{FAKE_PORT}', 'max_connections': streams,
+                                      'qps': qps, 'burst': max(int(qps), 1), 'tpm': 0}})
+    proxy = FastAPI(lifespan=_lifespan)
+    proxy.include_router(openai_gpt_api.router)
+    _serve(proxy, PROXY_PORT)
+    asyncio.run(_measure(streams))
+    print(f'模拟千帆: {fake_app.state.stats}')
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_cold_start.py
+# @时间       :2024/1/29 上午10:00
+# @作者       :lihb
+# @说明       : 冷启动耗时测试：导入 main 和 lifespan 启动的耗时，超过预算时以非 0 状态码退出，可用于 CI
+#               python -m benchmarks.bench_cold_start --env dev --import-budget 1.5 --startup-budget 0.5
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Annotated
+
+import typer
+
+from core.config import settings
+from core.nacos import EnvEnum, environment_name
+
+# 在全新的解释器中执行，lifespan 启动完成后直接退出，不等待nacos注销等网络操作
+PROBE = '''
+import asyncio, json, os, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def probe():
+    lifespan = main.app.router.lifespan_context(main.app)
+    begin = time.perf_counter()
+    await lifespan.__aenter__()
+    print(json.dumps({'import': imported - start, 'startup': time.perf_counter() - begin}), flush=True)
+    os._exit(0)
+
+asyncio.run(probe())
+'''
+
+
+def _probe(env: EnvEnum) -> dict:
+    environ = {**os.environ, environment_name: env.value}
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=settings.base_dir_str, env=environ,
+                            capture_output=True, text=True, timeout=60)
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    raise RuntimeError(f'启动失败:\n{result.stderr[-2000:]}')
+
+
+def run(env: Annotated[EnvEnum, typer.Option(help='需要加载的环境')] = EnvEnum.dev,
+        rounds: Annotated[int, typer.Option(help='测试次数，取中位数')] = 5,
+        import_budget: Annotated[float, typer.Option(help='导入 main 的耗时预算（秒）')] = 1.5,
+        startup_budget: Annotated[float, typer.Option(help='lifespan 启动的耗时预算（秒）')] = 0.5):
+    results = [_probe(env) for _ in range(rounds)]
+    import_time = statistics.median(r['import'] for r in results)
+    startup_time = statistics.median(r['startup'] for r in results)
+    print(f'导入 main       {import_time * 1000:8.1f}ms  预算 {import_budget * 1000:.0f}ms')
+    print(f'lifespan 启动   {startup_time * 1000:8.1f}ms  预算 {startup_budget * 1000:.0f}ms')
+    if import_time > import_budget or startup_time > startup_budget:
+        print('冷启动耗时超过预算', file=sys.stderr)
+        raise typer.Exit(code=1)
+
+
+if __name__ == '__main__':
+    typer.run(run)
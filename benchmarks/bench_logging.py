@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_logging.py
+# @时间       :2024/1/15 上午10:10
+# @作者       :lihb
+# @说明       : 日志吞吐量测试，对比 loguru 直接输出和经过标准库拦截的输出
+#               python -m benchmarks.bench_logging --count 100000
+import logging
+import os
+import sys
+import time
+from typing import Annotated
+
+import typer
+from loguru import logger
+
+from core import log
+from core.log import setup_logging
+
+
+def _measure(name: str, count: int, emit) -> None:
+    start = time.perf_counter()
+    for i in range(count):
+        emit(i)
+    # 日志先进入 BufferedSink 的队列，stop 在当前线程写出队列中剩余的日志，并等待写线程写完正在写的批次
+    log._stdout_sink.stop()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {count / elapsed:>12,.0f} 条/秒', file=sys.__stderr__)
+
+
+def run(count: Annotated[int, typer.Option(help='每项测试的日志条数')] = 100000):
+    # 日志输出到 /dev/null，只测量日志本身的开销
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        setup_logging()
+        std_logger = logging.getLogger('uvicorn.error')
+        _measure('loguru logger.info', count, lambda i: logger.info('message {}', i))
+        _measure('stdlib -> InterceptHandler', count, lambda i: std_logger.info('message %s', i))
+        _measure('stdlib 低于日志级别', count, lambda i: std_logger.debug('message %s', i))
+        _measure('loguru 低于日志级别', count, lambda i: logger.debug('message {}', i))
+    finally:
+        logger.remove()
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_metrics.py
+# @时间       :2024/2/2 下午2:10
+# @作者       :lihb
+# @说明       : 指标记录的开销（本地数组与共享文件）以及 /metrics 汇总所有 worker 的耗时
+#               python -m benchmarks.bench_metrics --count 1000000 --routes 50 --workers 16
+import os
+import tempfile
+import time
+from typing import Annotated
+
+import typer
+
+from core.metrics import MetricsRegistry
+
+
+def _registry(routes: int) -> tuple[MetricsRegistry, list]:
+    registry = MetricsRegistry()
+    labelvalues = [('GET', f'/api/route_{i}') for i in range(routes)]
+    duration = registry.histogram('http_request_duration_seconds', '请求耗时', ('method', 'route'), labelvalues)
+    return registry, [duration.labels(*values) for values in labelvalues]
+
+
+def _measure(name: str, count: int, func) -> None:
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {elapsed / count * 1e9:>10,.0f} ns/次')
+
+
+def run(count: Annotated[int, typer.Option(help='记录的次数')] = 1000000,
+        routes: Annotated[int, typer.Option(help='路由数')] = 50,
+        workers: Annotated[int, typer.Option(help='共享文件中已使用的槽数')] = 16):
+    registry, children = _registry(routes)
+    _measure('observe（绑定前，本地数组）', count, lambda i: children[i % routes].observe(i % 100 / 1000))
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'bench.metrics')
+        registry.bind(prefix)
+        _measure('observe（共享文件）', count, lambda i: children[i % routes].observe(i % 100 / 1000))
+        # 模拟其他 worker 占用的槽，只需要填上 pid
+        slot_bytes = (len(registry.values) + 1) * 8
+        view = memoryview(registry._mm).cast('d')
+        for slot in range(1, workers):
+            view[(slot + 1) * slot_bytes // 8 - 1] = os.getpid()
+        start = time.perf_counter()
+        text = registry.render()
+        print(f'render {workers} 个 worker      {(time.perf_counter() - start) * 1000:>10.1f} ms，'
+              f'{len(text.splitlines())} 行')
+        view.release()
+        registry.close()
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_middleware.py
+# @时间       :2024/1/22 上午11:30
+# @作者       :lihb
+# @说明       : ContextMiddleware 吞吐量测试，对比基于 BaseHTTPMiddleware 的旧实现
+#               python -m benchmarks.bench_middleware --count 5000
+import asyncio
+import time
+import uuid
+from typing import Annotated
+
+import httpx
+import typer
+from fastapi import FastAPI
+from loguru import logger
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+from core.config import request_id_var, request_time_it_var
+from core.middleware import ContextMiddleware
+
+
+class BaseHTTPContextMiddleware(BaseHTTPMiddleware):
+    """改造前基于 BaseHTTPMiddleware 的实现"""
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        start_time = time.time()
+        request_id = request.headers.get('X-Request-Id', str(uuid.uuid4()))
+        request_id_var.set(request_id)
+        response = await call_next(request)
+        process_time = time.time() - start_time
+        request_time_it_var.set(f'{process_time:.3f}')
+        return response
+
+
+def _create_app(middleware) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(middleware)
+
+    @app.get('/ping', response_class=PlainTextResponse)
+    async def ping():
+        return 'pong'
+
+    return app
+
+
+async def _measure(name: str, app: FastAPI, count: int, concurrency: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await client.get('/ping')
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(count)))
+        elapsed = time.perf_counter() - start
+    print(f'{name:<24} {count / elapsed:>10,.0f} req/s')
+
+
+def run(count: Annotated[int, typer.Option(help='请求数')] = 5000,
+        concurrency: Annotated[int, typer.Option(help='并发数')] = 50):
+    # 只测量中间件本身的开销，不输出日志
+    logger.remove()
+    asyncio.run(_measure('BaseHTTPMiddleware', _create_app(BaseHTTPContextMiddleware), count, concurrency))
+    asyncio.run(_measure('ASGI ContextMiddleware', _create_app(ContextMiddleware), count, concurrency))
+
+
+if __name__ == '__main__':
+    typer.run(run)
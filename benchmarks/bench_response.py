@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_response.py
+# @时间       :2024/1/23 下午2:10
+# @作者       :lihb
+# @说明       : R 响应序列化吞吐量测试，对比 JSONResponse(model_dump()) 和 RResponse
+#               python -m benchmarks.bench_response --count 20000
+import time
+from typing import Annotated
+
+import typer
+from starlette.responses import JSONResponse
+
+from schemas.base import R
+from utils.response import RResponse
+
+
+def _measure(name: str, count: int, render) -> None:
+    start = time.perf_counter()
+    for _ in range(count):
+        render()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {count / elapsed:>12,.0f} 次/秒')
+
+
+def run(count: Annotated[int, typer.Option(help='每项测试的序列化次数')] = 20000):
+    small = R[dict].success(data={'id': 1, 'name': '测试'})
+    large = R[list[dict]].success(data=[{'id': i, 'name': f'名称{i}', 'score': i * 0.5, 'tags': ['a', 'b', 'c']}
+                                        for i in range(1000)])
+    for name, r, n in (('小响应', small, count), ('大响应', large, max(count // 100, 1))):
+        assert JSONResponse(r.model_dump()).body == RResponse(r).body
+        _measure(f'{name} JSONResponse(model_dump())', n, lambda: JSONResponse(r.model_dump()))
+        _measure(f'{name} RResponse', n, lambda: RResponse(r))
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :bench_shared_cache.py
+# @时间       :2024/1/26 上午11:00
+# @作者       :lihb
+# @说明       : SharedHashTable 与进程内 dict 的读写吞吐量对比，以及多 worker 时回源次数的对比
+#               python -m benchmarks.bench_shared_cache --count 200000 --workers 4
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Annotated
+
+import typer
+
+from utils.commonality import SharedHashTable
+
+
+def _measure(name: str, count: int, func) -> None:
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {count / elapsed:>12,.0f} 次/秒')
+
+
+def _worker(path: str | None, keys: int, fetches) -> None:
+    """模拟一个 worker 读取 keys 个配置项，缓存中没有时回源"""
+    table = SharedHashTable(buckets=1024, ways=8, slot_size=256, path=path) if path else {}
+    for i in range(keys):
+        key = f'key-{i}'
+        value = table.get(key)
+        if value is None:
+            with fetches.get_lock():
+                fetches.value += 1
+            value = b'x' * 100
+            if path:
+                table.set(key, value, ttl=60)
+            else:
+                table[key] = value
+
+
+def _fetches(path: str | None, workers: int, keys: int) -> int:
+    ctx = multiprocessing.get_context('fork')
+    fetches = ctx.Value('i', 0)
+    processes = [ctx.Process(target=_worker, args=(path, keys, fetches)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return fetches.value
+
+
+def run(count: Annotated[int, typer.Option(help='每项测试的读写次数')] = 200000,
+        workers: Annotated[int, typer.Option(help='模拟的 worker 数')] = 4,
+        keys: Annotated[int, typer.Option(help='每个 worker 读取的键数')] = 1000):
+    value = b'x' * 100
+    with tempfile.TemporaryDirectory() as tmp:
+        table = SharedHashTable(buckets=8192, ways=8, slot_size=256, path=os.path.join(tmp, 'bench.mmap'))
+        local = {}
+        _measure('dict set', count, lambda i: local.__setitem__(f'key-{i % 10000}', value))
+        _measure('SharedHashTable set', count, lambda i: table.set(f'key-{i % 10000}', value, ttl=60))
+        _measure('dict get', count, lambda i: local.get(f'key-{i % 10000}'))
+        _measure('SharedHashTable get', count, lambda i: table.get(f'key-{i % 10000}'))
+        print(table.stats())
+        table.close()
+
+        print(f'{workers} 个 worker 各读取 {keys} 个键的回源次数:')
+        print(f'  进程内 dict         {_fetches(None, workers, keys):>8}')
+        print(f'  SharedHashTable     {_fetches(os.path.join(tmp, "workers.mmap"), workers, keys):>8}')
+
+
+if __name__ == '__main__':
+    typer.run(run)
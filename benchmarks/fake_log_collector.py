@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :fake_log_collector.py
+# @时间       :2024/2/5 下午2:00
+# @作者       :lihb
+# @说明       : 本地模拟的日志收集服务，接收 gzip 压缩的 NDJSON 批次，可以按比例返回 503 模拟故障
+#               python -m benchmarks.fake_log_collector --port 8901 --fail-rate 0.3
+#               nacos中把 log.export_url 配置为 http://127.0.0.1:8901/logs 即可联调
+import gzip
+import json
+import random
+from typing import Annotated
+
+import typer
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, Response
+
+
+def create_app(fail_rate: float = 0, keep: int = 1000) -> FastAPI:
+    """
+    :param fail_rate: 返回 503 的比例，用于验证重试和落盘
+    :param keep: 最多保留的最近日志条数，通过 /records 查看
+    """
+    app = FastAPI()
+    # 收到的批次数、日志条数、解压后字节数和返回 503 的次数
+    app.state.stats = {'batches': 0, 'records': 0, 'bytes': 0, 'failed': 0}
+    app.state.records = []
+
+    @app.post('/logs')
+    async def logs(request: Request):
+        if random.random() < fail_rate:
+            app.state.stats['failed'] += 1
+            return Response(status_code=503)
+        body = await request.body()
+        if request.headers.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        records = [json.loads(line) for line in body.splitlines() if line]
+        app.state.stats['batches'] += 1
+        app.state.stats['records'] += len(records)
+        app.state.stats['bytes'] += len(body)
+        app.state.records = (app.state.records + records)[-keep:]
+        return JSONResponse({'accepted': len(records)})
+
+    @app.get('/stats')
+    async def stats():
+        return app.state.stats
+
+    @app.get('/records')
+    async def records(limit: int = 100):
+        return app.state.records[-limit:]
+
+    return app
+
+
+def run(port: Annotated[int, typer.Option(help='监听端口')] = 8901,
+        fail_rate: Annotated[float, typer.Option(help='返回 503 的比例')] = 0,
+        keep: Annotated[int, typer.Option(help='最多保留的最近日志条数')] = 1000):
+    import uvicorn
+
+    uvicorn.run(create_app(fail_rate, keep), host='127.0.0.1', port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :fake_qianfan.py
+# @时间       :2024/1/24 下午2:00
+# @作者       :lihb
+# @说明       : 本地模拟的千帆服务，按固定间隔流式返回 token，用于联调和压测
+#               python -m benchmarks.fake_qianfan --port 8900
+#               nacos中把 qianfan.base_url 配置为 http://127.0.0.1:8900 即可联调
+import asyncio
+import json
+from typing import Annotated
+
+import typer
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+
+def create_app(tokens: int = 20, first_delay: float = 0.2, delay: float = 0.02) -> FastAPI:
+    """
+    :param tokens: 每次对话返回的 token 数
+    :param first_delay: 首个 token 之前的等待时间（秒），模拟模型的首字延迟
+    :param delay: 之后每个 token 之间的间隔（秒）
+    """
+    app = FastAPI()
+    # 统计完整返回和被客户端中途取消的对话数
+    app.state.stats = {'completed': 0, 'cancelled': 0}
+
+    @app.post('/oauth/2.0/token')
+    async def token():
+        return {'access_token': 'fake-token', 'expires_in': 2592000}
+
+    @app.post('/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{model}')
+    async def chat(model: str, request: Request):
+        if request.query_params.get('access_token') != 'fake-token':
+            return JSONResponse({'error_code': 110, 'error_msg': 'Access token invalid or no longer valid'})
+        body = await request.json()
+
+        async def events():
+            try:
+                await asyncio.sleep(first_delay)
+                for i in range(tokens):
+                    data = {'id': 'as-fake', 'object': 'chat.completion', 'sentence_id': i,
+                            'is_end': i == tokens - 1, 'result': f'{body["messages"][-1]["content"]}-{i}'}
+                    yield f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+                    await asyncio.sleep(delay)
+                app.state.stats['completed'] += 1
+            except asyncio.CancelledError:
+                app.state.stats['cancelled'] += 1
+                raise
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    @app.get('/stats')
+    async def stats():
+        return app.state.stats
+
+    return app
+
+
+def run(port: Annotated[int, typer.Option(help='监听端口')] = 8900,
+        tokens: Annotated[int, typer.Option(help='每次对话返回的 token 数')] = 20,
+        first_delay: Annotated[float, typer.Option(help='首个 token 的延迟（秒）')] = 0.2,
+        delay: Annotated[float, typer.Option(help='token 之间的间隔（秒）')] = 0.02):
+    import uvicorn
+
+    uvicorn.run(create_app(tokens, first_delay, delay), host='127.0.0.1', port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    typer.run(run)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :access_token.py
+# @时间       :2024/1/12 上午9:40
+# @作者       :lihb
+# @说明       : nacos的accessToken管理，提前在后台刷新，并在同主机的多个worker之间共享
+import asyncio
+import json
+import random
+import time
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+from core.metrics import metrics
+from utils.commonality import HostFileLock, SharedEnumMmap
+
+if TYPE_CHECKING:
+    from core.nacos import AsyncNacosHelper
+
+NACOS_TOKEN_REFRESHES = metrics.counter('nacos_token_refreshes_total', 'nacos登录获取token的次数')
+NACOS_TOKEN_REFRESH_FAILURES = metrics.counter('nacos_token_refresh_failures_total', 'nacos登录获取token失败的次数')
+
+
+class NacosTokenManager:
+    """nacos的accessToken管理
+
+    持有主机锁的 worker 在 token 过期前（tokenTtl * refresh_ratio，带随机抖动）登录刷新，
+    并把 token 写入共享内存，其他 worker 直接读取，请求路径上不需要等待登录。
+    """
+
+    def __init__(self, helper: "AsyncNacosHelper", shared_prefix: str, refresh_ratio: float = 0.8,
+                 jitter: float = 0.1):
+        self.helper = helper
+        self.refresh_ratio = refresh_ratio
+        self.jitter = jitter
+        self._token: dict | None = None
+        self._login_lock = asyncio.Lock()
+        self._host_lock = HostFileLock(f'{shared_prefix}.token.lock')
+        self._shared = SharedEnumMmap(4096, path=f'{shared_prefix}.token.mmap')
+
+    @staticmethod
+    def _valid(token: dict | None) -> bool:
+        return bool(token) and token.get('expiration_time', 0) > time.time()
+
+    def _read_shared(self):
+        """读取其他 worker 共享的 token，比本地的新时替换本地的"""
+        if not self._shared.version:
+            return
+        _, blob = self._shared.read_blob()
+        token = json.loads(blob)
+        if self._valid(token) and token['expiration_time'] > (self._token or {}).get('expiration_time', 0):
+            self._token = token
+
+    async def get_token(self) -> str:
+        """获取nacos token，只有本地和共享内存中都没有有效的 token 时才会登录"""
+        if not self._valid(self._token):
+            self._read_shared()
+        if not self._valid(self._token):
+            return await self.refresh()
+        return self._token['accessToken']
+
+    async def refresh(self, stale: str | None = None) -> str:
+        """登录获取新的 token
+
+        :param stale: 已失效的 token，当前 token 已经不是它时说明其他协程已经刷新过，不再重复登录
+        :return: 新的 token
+        """
+        async with self._login_lock:
+            # 其他 worker 可能已经刷新过
+            self._read_shared()
+            if self._valid(self._token) and (stale is None or self._token['accessToken'] != stale):
+                return self._token['accessToken']
+            nacos_uri = f'/nacos/v1/auth/login'
+
+            data = {
+                'username': self.helper.settings.username,
+                'password': self.helper.settings.password
+            }
+            NACOS_TOKEN_REFRESHES.inc()
+            try:
+                response = await self.helper.client.post(nacos_uri, data=data)
+                response.raise_for_status()
+                token_data = response.json()
+            except Exception:
+                NACOS_TOKEN_REFRESH_FAILURES.inc()
+                raise
+            now = time.time()
+            ttl = token_data['tokenTtl']
+            token_info = {
+                'accessToken': token_data['accessToken'],
+                'tokenTtl': ttl,
+                'expiration_time': now + ttl,
+                'refresh_time': now + ttl * self.refresh_ratio * random.uniform(1 - self.jitter, 1),
+            }
+            logger.info(f'获取nacos的token, 有效期 {ttl} 秒')
+            # 缓存 token 数据
+            self._token = token_info
+            if self._host_lock.held:
+                self._publish()
+            return token_info['accessToken']
+
+    def _publish(self):
+        self._shared.write_blob(json.dumps(self._token).encode('utf-8'))
+
+    async def run(self):
+        """任务工作函数，持有主机锁时提前刷新 token，否则定时读取共享的 token"""
+        while True:
+            if self._host_lock.try_acquire():
+                if not self._token or self._token['refresh_time'] <= time.time():
+                    await self.refresh(stale=self._token and self._token['accessToken'])
+                elif not self._shared.version:
+                    self._publish()
+                await asyncio.sleep(max(self._token['refresh_time'] - time.time(), 1))
+            else:
+                self._read_shared()
+                await asyncio.sleep(5)
+
+    def close(self):
+        self._host_lock.release()
+        self._shared.close()
@@ -4,11 +4,38 @@
 # @时间       :2023/9/21 上午11:03
 # @作者       :lihb
 # @说明       :
+import time
 from contextvars import ContextVar
 
-from .settings import Settings
+from .settings import Settings, SettingsHolder
 
-settings = Settings()
+# 每个请求固定使用的配置快照，由 ContextMiddleware 设置
+settings_var: ContextVar[Settings | None] = ContextVar('settings', default=None)
+settings = SettingsHolder(Settings(), settings_var)
 request_id_var: ContextVar[str] = ContextVar("request-id", default="")
 
-request_time_it_var: ContextVar[str] = ContextVar('process-time', default="")
+
+class RequestTimer:
+    """请求计时，格式化为字符串时得到请求开始至今的耗时（秒），stop 之后固定为请求总耗时"""
+    __slots__ = ('start', 'end')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def stop(self) -> float:
+        self.end = time.perf_counter()
+        return self.elapsed
+
+    def __str__(self):
+        return f'{self.elapsed:.3f}'
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+
+request_time_it_var: ContextVar[RequestTimer | str] = ContextVar('process-time', default="")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :discovery.py
+# @时间       :2024/1/8 上午10:20
+# @作者       :lihb
+# @说明       : 基于nacos的服务发现，本地缓存健康实例并按权重负载均衡
+import asyncio
+from typing import TYPE_CHECKING
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from core.exceptions import AiChatException
+from utils.commonality import ssl_context
+
+if TYPE_CHECKING:
+    from core.nacos import AsyncNacosHelper
+
+
+class ServiceInstance(BaseModel):
+    ip: str = Field(..., description='实例IP')
+    port: int = Field(..., description='实例端口')
+    weight: float = Field(1.0, description='nacos中配置的权重')
+    healthy: bool = Field(True, description='是否健康')
+    enabled: bool = Field(True, description='是否启用')
+    metadata: dict = Field(default_factory=dict, description='实例元数据')
+
+    @property
+    def key(self) -> str:
+        return f'{self.ip}:{self.port}'
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.ip}:{self.port}'
+
+
+class WeightedRoundRobin:
+    """平滑加权轮询（nginx 算法），权重为 nacos 中的 weight"""
+
+    def __init__(self):
+        self.instances: dict[str, ServiceInstance] = {}
+        self._current: dict[str, float] = {}
+
+    def update(self, instances: list[ServiceInstance]):
+        """增量更新实例列表，保留仍然存在的实例的当前权重，使切换实例列表时分配依旧平滑"""
+        self.instances = {i.key: i for i in instances if i.healthy and i.enabled and i.weight > 0}
+        self._current = {key: self._current.get(key, 0.0) for key in self.instances}
+
+    def choose(self) -> ServiceInstance | None:
+        best, total = None, 0.0
+        for key, instance in self.instances.items():
+            self._current[key] += instance.weight
+            total += instance.weight
+            if best is None or self._current[key] > self._current[best]:
+                best = key
+        if best is None:
+            return None
+        self._current[best] -= total
+        return self.instances[best]
+
+
+class NacosDiscovery:
+    """订阅服务的健康实例列表，请求路径上只读本地缓存，不产生额外的网络请求"""
+
+    def __init__(self, helper: "AsyncNacosHelper", refresh_interval: float = 10):
+        self.helper = helper
+        self.refresh_interval = refresh_interval
+        self._balancers: dict[str, WeightedRoundRobin] = {}
+        self._checksums: dict[str, str] = {}
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def subscribe(self, *service_names: str):
+        """订阅服务，实例列表由后台任务刷新"""
+        for service_name in service_names:
+            self._balancers.setdefault(service_name, WeightedRoundRobin())
+
+    async def refresh(self, service_name: str):
+        """从nacos拉取服务的健康实例，checksum 未变化时跳过
+
+        :return: nacos 建议的缓存时间（秒）
+        """
+        url = '/nacos/v1/ns/instance/list'
+        params = {
+            'serviceName': service_name,
+            'groupName': self.helper.settings.group,
+            'namespaceId': self.helper.settings.namespace,
+            'healthyOnly': 'true',
+        }
+        res = await self.helper.request('GET', url, params=params)
+        self.helper.err_status(res)
+        res_json = res.json()
+        checksum = res_json.get('checksum') or str(res_json.get('lastRefTime', ''))
+        if checksum and self._checksums.get(service_name) == checksum:
+            return res_json.get('cacheMillis', self.refresh_interval * 1000) / 1000
+        instances = [ServiceInstance.model_validate(host) for host in res_json.get('hosts', [])]
+        self._balancers.setdefault(service_name, WeightedRoundRobin()).update(instances)
+        self._checksums[service_name] = checksum
+        logger.info(f'刷新服务 {service_name} 实例列表 {[i.key for i in instances]}')
+        return res_json.get('cacheMillis', self.refresh_interval * 1000) / 1000
+
+    async def refresh_task_worker(self):
+        """任务工作函数，定时刷新所有已订阅服务的实例列表"""
+        while True:
+            interval = self.refresh_interval
+            for service_name in list(self._balancers):
+                try:
+                    interval = min(interval, await self.refresh(service_name))
+                except (httpx.HTTPError, AiChatException) as exc:
+                    logger.exception(exc)
+            await asyncio.sleep(interval)
+
+    def choose(self, service_name: str) -> ServiceInstance:
+        """按平滑加权轮询选择一个实例"""
+        balancer = self._balancers.get(service_name)
+        if balancer is None:
+            raise AiChatException(f'服务 {service_name} 未订阅')
+        instance = balancer.choose()
+        if instance is None:
+            raise AiChatException(f'服务 {service_name} 没有可用的实例')
+        return instance
+
+    def client(self, service_name: str) -> httpx.AsyncClient:
+        """每个上游服务一个保持长连接的连接池，请求时使用 :meth:`url` 拼接选中实例的地址"""
+        client = self._clients.get(service_name)
+        if client is None:
+            limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+            client = self._clients[service_name] = httpx.AsyncClient(limits=limits, timeout=30,
+                                                                      verify=ssl_context())
+        return client
+
+    def url(self, service_name: str, path: str = '') -> str:
+        """选择一个实例并返回完整的请求地址"""
+        return f'{self.choose(service_name).base_url}/{path.lstrip("/")}'
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
@@ -10,9 +10,10 @@ from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from loguru import logger
 from starlette.requests import Request
-from starlette.responses import JSONResponse
 
+from core.log import flush_tail_buffer
 from schemas.base import R
+from utils.response import RResponse
 
 
 # logger = logging.getLogger(__name__)
@@ -25,23 +26,30 @@ class AiChatException(Exception):
 
 def exception_handler(app: FastAPI) -> None:
     @app.exception_handler(RequestValidationError)
-    async def validation_exception_handler(request: Request, exc: RequestValidationError) -> JSONResponse:
+    async def validation_exception_handler(request: Request, exc: RequestValidationError) -> RResponse:
         """处理请求验证错误"""
+        # 输出该请求缓存的 DEBUG 日志，便于排查
+        flush_tail_buffer()
         # 记录日志并带上请求信息和验证错误详情
         logger.warning(f'Request validation error occurred for request {request.url}:{exc}')
         fail = R.fail(msg='校验错误', err=jsonable_encoder({"detail": exc.errors(), "body": exc.body}), code=422)
-        return JSONResponse(content=fail.model_dump(), status_code=fail.code)
+        return RResponse(content=fail, status_code=fail.code)
 
     @app.exception_handler(HTTPException)
     async def http_exception(request: Request, exc: HTTPException):
         """处理 HTTP 错误"""
+        # 输出该请求缓存的 DEBUG 日志，便于排查
+        flush_tail_buffer()
         # 记录日志
         logger.warning(f'HTTP error occurred for request {request.url}:{exc.detail}')
         fail = R.fail('请求错误', code=exc.status_code or 400, err=jsonable_encoder({"detail": exc.detail}))
-        return JSONResponse(content=fail.model_dump(), status_code=fail.code)
+        # 429 的 Retry-After 等响应头
+        return RResponse(content=fail, status_code=fail.code, headers=exc.headers)
 
     @app.exception_handler(AiChatException)
     async def ai_chat_exception(request: Request, exc: AiChatException):
+        # 输出该请求缓存的 DEBUG 日志，便于排查
+        flush_tail_buffer()
         logger.warning(f'自定义错误 {request.url}:{exc.message}')
         fail = R.fail(msg='自定义错误', code=400, err=jsonable_encoder({'detail': exc.message}))
-        return JSONResponse(content=fail.model_dump(), status_code=fail.code)
+        return RResponse(content=fail, status_code=fail.code)
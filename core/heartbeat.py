@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :heartbeat.py
+# @时间       :2024/1/10 下午2:15
+# @作者       :lihb
+# @说明       : nacos实例心跳，按服务端返回的间隔发送心跳，支持轻量心跳和自动重新注册
+import asyncio
+import json
+import random
+import time
+from typing import TYPE_CHECKING
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from core.exceptions import AiChatException
+from core.metrics import metrics
+
+if TYPE_CHECKING:
+    from core.nacos import AsyncNacosHelper
+
+# 服务端不认识该实例，需要重新注册
+INSTANCE_NOT_FOUND = 20404
+
+NACOS_HEARTBEATS = metrics.counter('nacos_heartbeats_total', 'nacos实例心跳发送次数')
+NACOS_HEARTBEAT_FAILURES = metrics.counter('nacos_heartbeat_failures_total', 'nacos实例心跳失败次数，包括重新注册失败')
+
+
+class NacosInstance(BaseModel):
+    ip: str = Field(..., description='实例IP')
+    port: int = Field(..., description='实例端口')
+    service_name: str = Field(..., description='服务名称')
+    group: str = Field(..., description='nacos组')
+    namespace: str = Field(..., description='nacos命名空间')
+    cluster: str = Field('DEFAULT', description='集群名称')
+    weight: float = Field(1.0, description='权重')
+    enabled: bool = Field(True, description='是否接收请求，退出前摘除实例时设置为 False')
+    metadata: dict = Field({"preserved.register.source": "SPRING_CLOUD"}, description='实例元数据')
+    interval: float = Field(5, description='心跳间隔（秒），以服务端返回的 clientBeatInterval 为准')
+    light_beat: bool = Field(False, description='服务端是否允许发送轻量心跳')
+    next_beat: float = Field(0, description='下一次发送心跳的时间（monotonic）')
+
+    @property
+    def key(self) -> str:
+        return f'{self.ip}:{self.port}'
+
+
+class NacosHeartbeat:
+    """在同一个循环中为多个实例发送心跳
+
+    每个实例按服务端返回的 clientBeatInterval 加上随机抖动安排下一次心跳，服务端允许时只发送轻量心跳，
+    服务端返回 20404 时自动重新注册。
+    """
+
+    def __init__(self, helper: "AsyncNacosHelper", jitter: float = 0.1):
+        self.helper = helper
+        self.jitter = jitter
+        self.instances: dict[str, NacosInstance] = {}
+
+    def add(self, instance: NacosInstance):
+        """添加需要发送心跳的实例，注册本身相当于一次心跳，所以从一个间隔之后开始"""
+        self._schedule(instance)
+        self.instances[instance.key] = instance
+
+    def remove(self, instance: NacosInstance):
+        self.instances.pop(instance.key, None)
+
+    def _schedule(self, instance: NacosInstance):
+        instance.next_beat = time.monotonic() + instance.interval * random.uniform(1 - self.jitter, 1)
+
+    async def beat(self, instance: NacosInstance):
+        """发送一次心跳
+
+        :return: 是否发送成功
+        """
+        url = f'/nacos/v1/ns/instance/beat'
+        service_name = f'{instance.group}@@{instance.service_name}'
+        params = {
+            'encoding': 'UTF-8',
+            'serviceName': service_name,
+            'namespaceId': instance.namespace,
+            'ip': instance.ip,
+            'port': instance.port,
+            'clusterName': instance.cluster,
+            'app': 'unknown',
+        }
+        if not instance.light_beat:
+            # 轻量心跳不需要携带实例信息
+            params['beat'] = json.dumps({"cluster": instance.cluster, "ip": instance.ip,
+                                         "metadata": instance.metadata, "period": int(instance.interval * 1000),
+                                         "port": instance.port, "scheduled": False,
+                                         "serviceName": service_name, "stopped": False,
+                                         "weight": instance.weight})
+        NACOS_HEARTBEATS.inc()
+        try:
+            res = await self.helper.request('PUT', url, params=params)
+            self.helper.err_status(res)
+        except (httpx.HTTPError, AiChatException) as exc:
+            NACOS_HEARTBEAT_FAILURES.inc()
+            logger.exception(exc)
+            return False
+        res_json = res.json()
+        logger.trace(f'发送实例心跳 {instance.key} {res_json}')
+        if res_json.get('clientBeatInterval'):
+            instance.interval = res_json['clientBeatInterval'] / 1000
+        instance.light_beat = bool(res_json.get('lightBeatEnabled'))
+        if res_json.get('code') == INSTANCE_NOT_FOUND:
+            logger.warning(f'nacos中不存在实例 {instance.key}，重新注册')
+            instance.light_beat = False
+            try:
+                await self.helper.add_instance(instance)
+            except (httpx.HTTPError, AiChatException) as exc:
+                NACOS_HEARTBEAT_FAILURES.inc()
+                logger.exception(exc)
+                return False
+        return True
+
+    async def beat_due(self):
+        """为所有到期的实例发送心跳
+
+        :return: 距离下一次心跳的秒数
+        """
+        now = time.monotonic()
+        due = [instance for instance in self.instances.values() if instance.next_beat <= now]
+        if due:
+            await asyncio.gather(*(self.beat(instance) for instance in due))
+        # 心跳后再安排下一次，使用服务端最新返回的间隔
+        for instance in due:
+            self._schedule(instance)
+        if not self.instances:
+            return 1
+        return max(min(instance.next_beat for instance in self.instances.values()) - time.monotonic(), 0)
+
+    async def run(self):
+        """任务工作函数，循环为所有实例发送心跳"""
+        while True:
+            await asyncio.sleep(await self.beat_due())
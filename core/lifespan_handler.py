@@ -5,24 +5,56 @@
 # @作者       :lihb
 # @说明       :
 from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
 
 from fastapi import FastAPI
 
-from core.log import setup_logging
-from core.nacos import NacosHelper
+from core.config import settings
+from core.log import bind_log_rate_limiter, setup_logging
+from core.metrics import metrics
+from core.nacos import AsyncNacosHelper
+from core.qianfan import QianFanClient
+from utils.scheduler import JobRunner
+
+
+# 收到 SIGTERM 后、停止接收请求前执行的回调，由 core.workers.GracefulServer 调用
+drain_callbacks: list[Callable[[], Awaitable]] = []
+
+
+def _reload_logging(_: set[str]):
+    setup_logging()
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
+async def lifespan(app: FastAPI):
     setup_logging()
-    # scheduler.start()
-    nacos_helper = NacosHelper()
+    # 只有日志相关的配置变化时才重新初始化日志
+    settings.subscribe(_reload_logging, 'log_level', 'log')
+    nacos_helper = AsyncNacosHelper()
+    # 同主机的 worker 共享指标文件，/metrics 汇总所有 worker
+    metrics.bind(f'{nacos_helper.shared_prefix}.metrics')
+    # 日志限流同样按整机计数
+    bind_log_rate_limiter(f'{nacos_helper.shared_prefix}.ratelimit')
     # 第一次加载配置文件
-    # nacos_helper.load_conf()
-    # 监听配置是否有变化
-    nacos_helper.run_listener_config_thread()
-    # 发送心跳到nacos
-    # scheduler.add_job(nacos_helper.put_instance, 'interval', seconds=5)
+    # await nacos_helper.load_conf()
+    # 监听配置是否有变化、注册实例并发送心跳到nacos，均以后台任务运行在事件循环中
+    await nacos_helper.start()
+    if nacos_helper.settings.register_instance:
+        # 收到 SIGTERM 后先从nacos摘除实例，再停止接收请求
+        drain_callbacks.append(nacos_helper.drain)
+    # 服务发现，接口中通过 request.app.state.discovery 调用其他服务
+    app.state.discovery = nacos_helper.discovery
+    # 千帆大模型客户端，所有请求共享一个连接池
+    app.state.qianfan = QianFanClient(quota_path=f'{nacos_helper.shared_prefix}.qianfan')
+    # 定时任务，通过 request.app.state.scheduler.add_job 添加，per_host 任务的文件锁与nacos选主锁放在一起
+    app.state.scheduler = JobRunner(lock_prefix=str(nacos_helper.shared_prefix))
+    await app.state.scheduler.start()
     yield
-    # scheduler.shutdown()
-    nacos_helper.close()
+    await app.state.scheduler.shutdown()
+    if nacos_helper.drain in drain_callbacks:
+        drain_callbacks.remove(nacos_helper.drain)
+    await app.state.qianfan.close()
+    await nacos_helper.close()
+    metrics.close()
+    # 应用在同一个进程中重新启动时（如测试）不重复订阅
+    settings.unsubscribe(_reload_logging)
@@ -4,46 +4,434 @@
 # @时间       :2023/9/21 上午11:06
 # @作者       :lihb
 # @说明       :
-import inspect
+import hashlib
 import logging
+import re
+import struct
 import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextvars import ContextVar, Token
+from typing import TextIO
 
+import pydantic_core
 from loguru import logger
 
 from core.config import request_id_var, request_time_it_var, settings
+from core.log_export import HttpLogShipper
+from core.metrics import metrics
+from utils.commonality import SharedHashTable
+
+
+_LOGGING_FILE = logging.__file__
+
+
+class RateLimiter:
+    """按调用位置（模块、函数、行号）和消息模板限流
+
+    每个调用位置在 window 秒的窗口内各级别最多输出 limits[level] 条，超出的日志被抑制。
+    被抑制的条数在窗口结束后由后台线程汇总输出一条，洪泛停止后也能看到；
+    窗口结束后该调用位置的第一条日志同样会带上被抑制的条数。未配置限流的级别直接放行。
+
+    计数保存在 :class:`SharedHashTable` 中，:meth:`bind` 之后同主机的所有 worker 共用，整机每个调用位置每个窗口
+    最多输出 limits 条。条目在最后一条日志之后保留 window + grace 秒等待汇总；桶满时淘汰最早过期的条目，
+    其中还没有汇总的抑制条数不再输出。
+    """
+    # 窗口开始时间、窗口内输出条数、被抑制条数，之后是汇总使用的 "级别\x00调用位置 消息"
+    state = struct.Struct('<dII')
+    slot_size = 256
+    # 键为 32 个字符的哈希值
+    summary_size = slot_size - SharedHashTable.slot_header.size - 32 - state.size
+    grace = 30
+
+    def __init__(self, buckets: int = 1024, ways: int = 8):
+        self.buckets = buckets
+        self.ways = ways
+        self.limits: dict[int, int] = {}
+        self.window = 60.0
+        self.suppressed_total = 0
+        self.table: SharedHashTable | None = None
+        self._reporter: threading.Thread | None = None
+
+    def bind(self, path: str | None):
+        """计数改为保存在 path 中，path 为空时只在当前进程（及 fork 出来的子进程）内计数
+
+        之前的表可能还在被其他线程读写，不关闭。
+        """
+        self.table = SharedHashTable(self.buckets, self.ways, self.slot_size, path)
+
+    def configure(self, enabled: bool, limits: dict[str, int], window: float):
+        self.limits = {logger.level(level).no: limit for level, limit in limits.items()} if enabled else {}
+        self.window = window
+        if self.limits and self._reporter is None:
+            self._reporter = threading.Thread(target=self._report_loop, name='log-rate-limit', daemon=True)
+            self._reporter.start()
+
+    def __call__(self, record) -> bool:
+        """返回是否放行，新窗口的第一条日志如果之前有被抑制的日志会在消息后追加抑制条数"""
+        limit = self.limits.get(record['level'].no)
+        if limit is None or '_rate_limit_summary' in record['extra']:
+            return True
+        if self.table is None:
+            self.bind(None)
+        callsite = f'{record["name"]}:{record["function"]}:{record["line"]}'
+        template = _DIGITS.sub('0', record['message'][:200])
+        key = hashlib.blake2b(f'{callsite}\x00{template}'.encode('utf-8'), digest_size=16).hexdigest()
+        now = time.time()
+
+        def count(value: bytes | None) -> tuple[bytes, tuple[bool, int]]:
+            suppressed = 0
+            if value is not None:
+                start, passed, suppressed = self.state.unpack_from(value)
+                if now - start < self.window:
+                    if passed < limit:
+                        return self.state.pack(start, passed + 1, suppressed) + value[self.state.size:], (True, 0)
+                    return self.state.pack(start, passed, suppressed + 1) + value[self.state.size:], (False, 0)
+            # 新的窗口，带出上一个窗口还没有汇总的抑制条数
+            summary = f'{record["level"].name}\x00{callsite} {record["message"][:200]}'.encode('utf-8')
+            return self.state.pack(now, 1, 0) + summary[:self.summary_size], (True, suppressed)
+
+        allowed, suppressed = self.table.update(key, count, ttl=self.window + self.grace)
+        if not allowed:
+            self.suppressed_total += 1
+            LOG_SUPPRESSED.inc()
+            return False
+        if suppressed:
+            record['message'] += f' [已抑制 {suppressed} 条相似日志]'
+        return True
+
+    def report_expired(self):
+        """输出窗口已经结束、还没有汇总过的抑制条数"""
+        if self.table is None:
+            return
+        now = time.time()
+        summaries = []
+
+        def harvest(value: bytes) -> bytes | None:
+            start, passed, suppressed = self.state.unpack_from(value)
+            if not suppressed or now - start < self.window:
+                return None
+            # 只有一个 worker 能在锁内清零，汇总不会重复输出
+            summaries.append((value[self.state.size:], suppressed))
+            return self.state.pack(start, passed, 0) + value[self.state.size:]
+
+        self.table.update_items(harvest)
+        for summary, suppressed in summaries:
+            level, message = summary.decode('utf-8', 'ignore').split('\x00', 1)
+            logger.bind(_rate_limit_summary=True).log(level, f'已抑制 {suppressed} 条相似日志: {message}')
+
+    def _report_loop(self):
+        while True:
+            time.sleep(min(self.window, 5))
+            try:
+                self.report_expired()
+            except Exception as exc:
+                sys.stderr.write(f'输出日志限流汇总失败: {exc}\n')
+
+
+_DIGITS = re.compile(r'\d+')
+_rate_limiter = RateLimiter()
 
 
 def _logger_filter(record):
-    record['extra'].update(request_id_var=request_id_var.get(None))
-    record['extra'].update(request_time_it_var=request_time_it_var.get('').strip())
-    return record
+    # 每条日志都会调用，只做两次 ContextVar 读取和字典赋值，限流只对配置了的级别生效
+    extra = record['extra']
+    extra['request_id_var'] = request_id_var.get(None)
+    extra['request_time_it_var'] = request_time_it_var.get()
+    if not _rate_limiter(record):
+        extra['_suppressed'] = True
+
+
+def _not_suppressed(record) -> bool:
+    return '_suppressed' not in record['extra']
 
 
 class InterceptHandler(logging.Handler):
-    def emit(self, record: logging.LogRecord) -> None:
+    # 标准库日志级别名称到 loguru 级别的缓存
+    _levels: dict[str, str | int] = {}
+
+    def _level(self, record: logging.LogRecord) -> str | int:
         # Get corresponding Loguru level if it exists.
-        level: str | int
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
-        # print(level)
+        level = self._levels.get(record.levelname)
+        if level is None:
+            try:
+                level = logger.level(record.levelname).name
+            except ValueError:
+                level = record.levelno
+            self._levels[record.levelname] = level
+        return level
+
+    def emit(self, record: logging.LogRecord) -> None:
+        level = self._level(record)
         # Find caller from where originated the logged message.
-        frame, depth = inspect.currentframe(), 0
-        while frame and (depth == 0 or frame.f_code.co_filename == logging.__file__):
+        # 从 emit 的调用方开始，跳过 logging 模块自身的栈帧
+        frame, depth = sys._getframe(1), 1
+        while frame and frame.f_code.co_filename == _LOGGING_FILE:
             frame = frame.f_back
             depth += 1
 
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
 
+LOG_SINKS = [('stdout',), ('export',)]
+LOG_QUEUE_DEPTH = metrics.gauge('log_queue_depth', '日志输出队列中等待写出的日志条数', ('sink',), LOG_SINKS)
+LOG_DROPPED = metrics.counter('log_dropped_total', '日志输出队列满时丢弃的日志条数', ('sink',), LOG_SINKS)
+LOG_WRITTEN = metrics.counter('log_written_total', '已写出的日志条数', ('sink',), LOG_SINKS)
+LOG_SUPPRESSED = metrics.counter('log_suppressed_total', '被限流抑制的日志条数')
+
+
+class BufferedSink:
+    """有界的非阻塞日志输出
+
+    loguru 在调用方线程中格式化日志后放入有界队列，由写线程按批合并成一次 write 调用写出。
+    队列满时按 overflow_policy 处理：block 阻塞调用方直到有空间；drop_oldest 丢弃最旧的日志；
+    drop_below_level 丢弃新来的低于 drop_below_level 的日志，更高级别的日志挤掉最旧的日志。
+    """
+
+    def __init__(self, stream: TextIO, name: str = 'stdout'):
+        self.stream = stream
+        self.dropped = 0
+        self.written = 0
+        self._depth_gauge = LOG_QUEUE_DEPTH.labels(name)
+        self._dropped_counter = LOG_DROPPED.labels(name)
+        self._written_counter = LOG_WRITTEN.labels(name)
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        # 保证写线程和 stop 写出的批次不会交错，日志顺序不变
+        self._write_lock = threading.Lock()
+        self.configure()
+        self._thread = threading.Thread(target=self._worker, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def configure(self, queue_size: int = 10000, batch_size: int = 512, flush_interval: float = 0.2,
+                  overflow_policy: str = 'block', drop_below_level: str = 'WARNING'):
+        with self._cond:
+            self.queue_size = queue_size
+            self.batch_size = batch_size
+            self.flush_interval = flush_interval
+            self.overflow_policy = overflow_policy
+            self.drop_below_level = logger.level(drop_below_level).no
+
+    @property
+    def depth(self) -> int:
+        """队列中等待写出的日志条数"""
+        return len(self._queue)
+
+    def write(self, message):
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                if self.overflow_policy == 'block':
+                    self._cond.notify_all()
+                    self._cond.wait_for(lambda: len(self._queue) < self.queue_size)
+                elif (self.overflow_policy == 'drop_below_level'
+                      and message.record['level'].no < self.drop_below_level):
+                    self.dropped += 1
+                    self._dropped_counter.inc()
+                    return
+                else:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    self._dropped_counter.inc()
+            self._queue.append(message)
+            self._depth_gauge.set(len(self._queue))
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _take_batch(self) -> list:
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        self._depth_gauge.set(len(self._queue))
+        # 唤醒因队列满而阻塞的调用方
+        self._cond.notify_all()
+        return batch
+
+    def _write_batch(self, batch: list, flush: bool = True):
+        if batch:
+            self.stream.write(''.join(batch))
+            self.written += len(batch)
+            self._written_counter.inc(len(batch))
+        # 没有新日志时也调用 flush，攒批的输出流可以按时间发送
+        if flush:
+            self.stream.flush()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._queue) >= self.batch_size, timeout=self.flush_interval)
+            with self._write_lock:
+                with self._cond:
+                    batch = self._take_batch()
+                try:
+                    self._write_batch(batch)
+                except Exception as exc:
+                    sys.stderr.write(f'写入日志失败: {exc}\n')
+
+    def stop(self):
+        """在调用方线程中写出队列中的所有日志，loguru 移除 sink 时会调用。
+
+        不能命名为 flush，loguru 每写一条日志都会调用 sink 的 flush。写线程继续运行，sink 可以再次添加。
+        输出流有 stop 方法时（如 :class:`HttpLogShipper`）剩余的日志交给它处理，这里不触发网络发送；
+        写线程正在发送时不等待，队列中的日志由写线程继续写出，避免配置更新时阻塞事件循环。
+        """
+        stream_stop = getattr(self.stream, 'stop', None)
+        if not self._write_lock.acquire(blocking=not callable(stream_stop)):
+            return
+        try:
+            while True:
+                with self._cond:
+                    batch = self._take_batch()
+                if not batch:
+                    break
+                self._write_batch(batch, flush=not callable(stream_stop))
+            if callable(stream_stop):
+                stream_stop()
+        finally:
+            self._write_lock.release()
+
+    def stats(self) -> dict:
+        return {'depth': self.depth, 'dropped': self.dropped, 'written': self.written}
+
+
+def serialize_record(record) -> bytes:
+    """将 loguru 的 record 直接序列化为一行 JSON，不经过文本格式化"""
+    exception = record['exception']
+    data = {
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'message': record['message'],
+        'name': record['name'],
+        'function': record['function'],
+        'line': record['line'],
+        'file': record['file'].path,
+        'elapsed': record['elapsed'].total_seconds(),
+        'process': {'id': record['process'].id, 'name': record['process'].name},
+        'thread': {'id': record['thread'].id, 'name': record['thread'].name},
+        'request_id': record['extra'].get('request_id_var'),
+        'request_time': record['extra'].get('request_time_it_var'),
+        'extra': {key: value for key, value in record['extra'].items()
+                  if not key.startswith('_') and not key.endswith('_var')},
+    }
+    if exception:
+        data['exception'] = ''.join(traceback.format_exception(exception.type, exception.value,
+                                                               exception.traceback))
+    return pydantic_core.to_json(data, fallback=str)
+
+
+def json_format(record) -> str:
+    """loguru 的 format 函数，输出 JSON 行"""
+    record['extra']['_json'] = serialize_record(record).decode('utf-8')
+    return '{extra[_json]}\n'
+
+
+TEXT_FORMAT = ('[<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green>] '
+               '[<magenta>{process.name}</magenta>:<yellow>{thread.name}</yellow>] '
+               '[<cyan>{name}</cyan>:<cyan>{function}</cyan>:<yellow>{line}</yellow>] '
+               '[<level>{level}</level>] '
+               '[{extra[request_id_var]}] '
+               '[{extra[request_time_it_var]}] '
+               '<level>{message}</level>')
+
+_stdout_sink: BufferedSink | None = None
+_export_sink: BufferedSink | None = None
+
+
+class TailBuffer:
+    """单个请求中低于日志级别的日志"""
+    __slots__ = ('records', 'failed')
+
+    def __init__(self, max_records: int):
+        self.records: deque = deque(maxlen=max_records)
+        # 已经输出过缓存，之后的日志也需要在请求结束时输出
+        self.failed = False
+
+
+# 当前请求的日志缓存，由 ContextMiddleware 设置，不以客户端传入的 X-Request-Id 为键，并发请求使用相同的ID也互不影响
+_tail_buffer_var: ContextVar[TailBuffer | None] = ContextVar('tail-buffer', default=None)
+_tail_level_no = 0
+
+
+def _tail_filter(record) -> bool:
+    # filter 和 sink 都在打日志的调用方中同步执行，能读到该请求的 ContextVar
+    return (record['level'].no < _tail_level_no and _tail_buffer_var.get() is not None
+            and _not_suppressed(record))
+
+
+def _tail_sink(message):
+    buffer = _tail_buffer_var.get()
+    if buffer is not None:
+        buffer.records.append(message)
+
+
+class _ExportMessage(str):
+    """推送给日志收集服务的 JSON 行，带上 record 供 BufferedSink 按级别丢弃"""
+    record: dict
+
+
+def _export_message(message) -> str:
+    """缓存的日志按标准输出的格式保存，推送时不论标准输出是什么格式都使用 JSON 行"""
+    if settings.log.format == 'json':
+        return message
+    exported = _ExportMessage(serialize_record(message.record).decode('utf-8') + '\n')
+    exported.record = message.record
+    return exported
+
+
+def begin_tail_buffer() -> Token | None:
+    """开始缓存当前请求中低于日志级别的日志，返回值用于 :meth:`end_tail_buffer`，未开启 tail_buffer 时返回 None"""
+    if not settings.log.tail_buffer:
+        return None
+    return _tail_buffer_var.set(TailBuffer(settings.log.tail_max_records))
+
+
+def flush_tail_buffer():
+    """立即输出当前请求缓存的日志，请求结束时剩余的缓存日志也会输出，供异常处理器调用"""
+    buffer = _tail_buffer_var.get()
+    if buffer is None:
+        return
+    buffer.failed = True
+    export = _export_sink is not None and settings.log.export_url
+    while buffer.records:
+        message = buffer.records.popleft()
+        _stdout_sink.write(message)
+        if export:
+            _export_sink.write(_export_message(message))
+
+
+def end_tail_buffer(token: Token | None, flush: bool = False):
+    """结束当前请求的日志缓存，请求失败或过慢时输出缓存的日志，否则丢弃
+
+    :param token: :meth:`begin_tail_buffer` 的返回值
+    :param flush: 是否输出缓存的日志
+    """
+    if token is None:
+        return
+    buffer = _tail_buffer_var.get()
+    if buffer is not None and (flush or buffer.failed):
+        flush_tail_buffer()
+    _tail_buffer_var.reset(token)
+
+
+def get_log_sink_stats() -> dict:
+    """日志输出队列的统计信息：队列深度、丢弃条数、已写出条数"""
+    return _stdout_sink.stats() if _stdout_sink else {'depth': 0, 'dropped': 0, 'written': 0}
+
+
+def bind_log_rate_limiter(path: str):
+    """日志限流的计数改为保存在 path 中，同主机的所有 worker 共用，整机按调用位置限流"""
+    _rate_limiter.bind(path)
+
+
 def setup_logging():
     # LOG_LEVEL = logging.getLevelName(settings.log_level)
 
     # intercept everything at the root logger
     # logging.root.handlers = [InterceptHandler()]
     # logging.root.setLevel(LOG_LEVEL)
-    logging.basicConfig(handlers=[InterceptHandler()], level=0, force=True)
+    # 低于日志级别的标准库日志在 logging 内部就被丢弃，不再进入 InterceptHandler
+    # 开启 tail_buffer 时需要接收所有级别的日志放入请求缓存
+    root_level = 0 if settings.log.tail_buffer else logger.level(settings.log_level).no
+    logging.basicConfig(handlers=[InterceptHandler()], level=root_level, force=True)
 
     # remove every other logger's handlers
     # and propagate to root logger
@@ -53,19 +441,46 @@ def setup_logging():
     logger.remove()  # Will remove all handlers already configured
     # configure loguru
     logger.configure(patcher=_logger_filter)
-    logger.disable('httpcore')
-    logger.disable('httpx')
-    logger.disable('apscheduler')
+    for name in ('httpcore', 'httpx'):
+        logger.disable(name)
+        # 标准库中同样禁用，避免这些日志经过 InterceptHandler 后才被丢弃
+        logging.getLogger(name).disabled = True
     # logger.enable('qianfan')
-    logger.add(sys.stdout, level=settings.log_level, colorize=True, enqueue=True,
-               format='[<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green>] '
-                      '[<magenta>{process.name}</magenta>:<yellow>{thread.name}</yellow>] '
-                      '[<cyan>{name}</cyan>:<cyan>{function}</cyan>:<yellow>{line}</yellow>] '
-                      '[<level>{level}</level>] '
-                      '[{extra[request_id_var]}] '
-                      '[{extra[request_time_it_var]}] '
-                      '<level>{message}</level>',
-               )
+    global _stdout_sink, _export_sink
+    log_setting = settings.log
+    queue_setting = log_setting.model_dump(include={'queue_size', 'batch_size', 'flush_interval',
+                                                    'overflow_policy', 'drop_below_level'})
+    if _stdout_sink is None:
+        _stdout_sink = BufferedSink(sys.stdout)
+    _stdout_sink.configure(**queue_setting)
+    _rate_limiter.configure(log_setting.rate_limit, log_setting.rate_limit_counts, log_setting.rate_limit_window)
+    if log_setting.format == 'json':
+        logger.add(_stdout_sink, level=settings.log_level, colorize=False, format=json_format,
+                   filter=_not_suppressed)
+    else:
+        logger.add(_stdout_sink, level=settings.log_level, colorize=True, format=TEXT_FORMAT,
+                   filter=_not_suppressed)
+    if log_setting.tail_buffer:
+        # 该 sink 只接收请求中低于日志级别的日志，放入请求的缓存，格式与标准输出一致
+        global _tail_level_no
+        _tail_level_no = logger.level(settings.log_level).no
+        logger.add(_tail_sink, level='TRACE', filter=_tail_filter, colorize=log_setting.format != 'json',
+                   format=json_format if log_setting.format == 'json' else TEXT_FORMAT)
+    if log_setting.export_url:
+        if _export_sink is None:
+            _export_sink = BufferedSink(HttpLogShipper(
+                    str(log_setting.export_url), log_setting.export_spill_dir or settings.base_dir / '.log_spill'),
+                    name='export')
+        shipper = _export_sink.stream
+        shipper.url = str(log_setting.export_url)
+        shipper.spill_dir = log_setting.export_spill_dir or settings.base_dir / '.log_spill'
+        shipper.batch_bytes = log_setting.export_batch_bytes
+        shipper.interval = log_setting.export_interval
+        shipper.retries = log_setting.export_retries
+        # 推送队列满时不能阻塞调用方，收集服务不可用时日志落盘或丢弃
+        _export_sink.configure(**{**queue_setting, 'overflow_policy': log_setting.export_overflow_policy})
+        logger.add(_export_sink, level=settings.log_level, colorize=False, format=json_format,
+                   filter=_not_suppressed)
     # logger.level(settings.log_level)
     logging.info(f'初始化日志配置 {settings.log_level}')
     # logging.info(settings.log_level)
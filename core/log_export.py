@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :log_export.py
+# @时间       :2024/1/18 下午3:20
+# @作者       :lihb
+# @说明       : 结构化日志批量压缩后推送到日志收集服务，失败时落盘，恢复后补发
+import gzip
+import os
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from utils.commonality import ssl_context
+
+
+class HttpLogShipper:
+    """将 JSON 行格式（NDJSON）的日志按大小或时间攒批，gzip 压缩后 POST 到日志收集服务
+
+    作为 :class:`core.log.BufferedSink` 的输出流使用，write/flush 都在日志写线程中调用。
+    发送失败会按指数退避重试，重试仍失败时把压缩后的批次写入 spill_dir，之后发送成功时按时间顺序补发。
+    """
+
+    def __init__(self, url: str, spill_dir: Path, batch_bytes: int = 1024 * 1024, interval: float = 5,
+                 retries: int = 3, max_spill_bytes: int = 100 * 1024 * 1024, timeout: float = 10):
+        self.url = url
+        self.spill_dir = spill_dir
+        self.batch_bytes = batch_bytes
+        self.interval = interval
+        self.retries = retries
+        self.max_spill_bytes = max_spill_bytes
+        self.sent = 0
+        self.failed = 0
+        self._buffer: list[bytes] = []
+        self._buffer_size = 0
+        self._last_send = time.monotonic()
+        self.client = httpx.Client(timeout=timeout, verify=ssl_context(),
+                                   headers={'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'})
+
+    def write(self, data: str):
+        chunk = data.encode('utf-8')
+        self._buffer.append(chunk)
+        self._buffer_size += len(chunk)
+
+    def flush(self, force: bool = False):
+        """缓冲区达到 batch_bytes 或距离上一次发送超过 interval 时发送"""
+        if not self._buffer:
+            return
+        if not force and self._buffer_size < self.batch_bytes and time.monotonic() - self._last_send < self.interval:
+            return
+        payload = gzip.compress(b''.join(self._buffer))
+        self._buffer.clear()
+        self._buffer_size = 0
+        self._last_send = time.monotonic()
+        if self._post(payload):
+            self._resend_spilled()
+        else:
+            self._spill(payload)
+
+    def _post(self, payload: bytes) -> bool:
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.client.post(self.url, content=payload)
+                if res.status_code < 300:
+                    self.sent += 1
+                    return True
+                if res.status_code < 500 and res.status_code != 429:
+                    # 客户端错误重试也不会成功
+                    break
+            except httpx.HTTPError:
+                pass
+            if attempt < self.retries:
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+        self.failed += 1
+        return False
+
+    def _spilled_files(self) -> list[Path]:
+        return sorted(self.spill_dir.glob('*.ndjson.gz'))
+
+    def _spill(self, payload: bytes):
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            (self.spill_dir / f'{time.time_ns()}-{os.getpid()}.ndjson.gz').write_bytes(payload)
+            # 超过上限时丢弃最旧的批次
+            files = self._spilled_files()
+            total = sum(file.stat().st_size for file in files)
+            while files and total > self.max_spill_bytes:
+                oldest = files.pop(0)
+                total -= oldest.stat().st_size
+                oldest.unlink(missing_ok=True)
+        except OSError as exc:
+            sys.stderr.write(f'日志落盘失败: {exc}\n')
+
+    def _resend_spilled(self):
+        if not self.spill_dir.exists():
+            return
+        for file in self._spilled_files():
+            # 先改名占用，避免多个 worker 重复补发同一个批次
+            sending = file.with_name(f'{file.name}.{os.getpid()}.sending')
+            try:
+                file.rename(sending)
+            except FileNotFoundError:
+                continue
+            if not self._post(sending.read_bytes()):
+                sending.rename(file)
+                return
+            sending.unlink(missing_ok=True)
+
+    def stop(self):
+        """将缓冲区中剩余的日志写入 spill_dir，日志 sink 被移除时调用
+
+        sink 在配置更新时也会被移除，这里不发送网络请求，落盘的批次在下一次发送成功后补发
+        """
+        if not self._buffer:
+            return
+        payload = gzip.compress(b''.join(self._buffer))
+        self._buffer.clear()
+        self._buffer_size = 0
+        self._spill(payload)
+
+    def close(self):
+        self.stop()
+        self.client.close()
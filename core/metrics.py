@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :metrics.py
+# @时间       :2024/2/2 上午10:30
+# @作者       :lihb
+# @说明       : Prometheus 指标，同主机的多个 worker 通过文件映射共享计数，/metrics 汇总所有 worker
+import bisect
+import hashlib
+import math
+import mmap
+import os
+from array import array
+from typing import Iterable, Iterator
+
+from loguru import logger
+
+from utils.commonality import HostFileLock, open_shared_file
+
+# Response 会自动加上 charset=utf-8
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """单调递增的计数器，同主机所有 worker 的值相加后输出"""
+    __slots__ = ('registry', 'index', 'labelvalues')
+
+    def __init__(self, registry: 'MetricsRegistry', index: int, labelvalues: tuple[str, ...]):
+        self.registry = registry
+        self.index = index
+        self.labelvalues = labelvalues
+
+    def inc(self, amount: float = 1):
+        self.registry.values[self.index] += amount
+
+
+class Gauge(Counter):
+    """当前值，每个存活的 worker 单独输出一条，带 pid 标签"""
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.registry.values[self.index] = value
+
+    def dec(self, amount: float = 1):
+        self.registry.values[self.index] -= amount
+
+
+class Histogram(Counter):
+    """固定桶的直方图，每个桶（含 +Inf）各占一个计数，最后一个位置为观测值之和，输出时再转换为累计值"""
+    __slots__ = ('buckets',)
+
+    def __init__(self, registry: 'MetricsRegistry', index: int, labelvalues: tuple[str, ...],
+                 buckets: tuple[float, ...]):
+        super().__init__(registry, index, labelvalues)
+        self.buckets = buckets
+
+    def observe(self, value: float):
+        values = self.registry.values
+        values[self.index + bisect.bisect_left(self.buckets, value)] += 1
+        values[self.index + len(self.buckets) + 1] += value
+
+
+class Metric:
+    """一个指标及其所有标签组合，标签组合在声明时确定，之后不能再增加"""
+    _types = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+    def __init__(self, registry: 'MetricsRegistry', kind: str, name: str, documentation: str,
+                 labelnames: tuple[str, ...], labelvalues: list[tuple[str, ...]], buckets: tuple[float, ...]):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.width = len(buckets) + 2 if kind == 'histogram' else 1
+        self.children: dict[tuple[str, ...], Counter] = {}
+        for values in labelvalues:
+            if len(values) != len(labelnames):
+                raise ValueError(f'指标 {name} 的标签 {values} 与 {labelnames} 数量不一致')
+            index = registry.allocate(self.width)
+            if kind == 'histogram':
+                self.children[values] = Histogram(registry, index, values, buckets)
+            else:
+                self.children[values] = self._types[kind](registry, index, values)
+
+    def labels(self, *values: str):
+        return self.children[values]
+
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    @property
+    def layout(self) -> str:
+        return f'{self.kind} {self.name} {self.labelnames} {list(self.children)} {self.buckets}'
+
+
+class MetricsRegistry:
+    """同主机多个 worker 共享的指标存储
+
+    所有指标的值都是 float64，按声明顺序排列。进程启动后先记录在本地数组中，:meth:`bind` 之后
+    每个进程在共享文件中独占一个槽（用 :class:`HostFileLock` 选出），只写自己的槽，
+    热路径上只是对 memoryview 的一次加法，不需要加锁。:meth:`render` 读取所有槽：
+    counter 和直方图把所有用过的槽相加，worker 重启后沿用原来的槽并在原来的值上继续累加，汇总值保持单调递增；
+    gauge 只输出进程还存活的槽。文件名带有指标布局的哈希，不同版本的进程不会共用同一个文件。
+    """
+
+    def __init__(self, slots: int = 64):
+        self.slots = slots
+        self.metrics: dict[str, Metric] = {}
+        self.values: array | memoryview = array('d')
+        self.path: str | None = None
+        self._mm: mmap.mmap | None = None
+        self._lock: HostFileLock | None = None
+
+    def allocate(self, width: int) -> int:
+        if self._mm is not None:
+            raise RuntimeError('指标需要在 bind 之前声明')
+        index = len(self.values)
+        self.values.extend([0.0] * width)
+        return index
+
+    def _declare(self, kind: str, name: str, documentation: str, labelnames: Iterable[str],
+                 labelvalues: Iterable[Iterable[str]], buckets: Iterable[float] = ()) -> Metric:
+        labelnames = tuple(labelnames)
+        labelvalues = [tuple(values) for values in labelvalues]
+        buckets = tuple(float(bound) for bound in buckets)
+        metric = self.metrics.get(name)
+        if metric is not None:
+            # 同一个模块被重复导入（例如 spawn 启动的 worker 会先以 __mp_main__ 导入 main）时返回已声明的指标
+            if (metric.kind, metric.labelnames, list(metric.children), metric.buckets) == (
+                    kind, labelnames, labelvalues, buckets):
+                return metric
+            raise ValueError(f'指标 {name} 已经声明过')
+        metric = self.metrics[name] = Metric(self, kind, name, documentation, labelnames, labelvalues, buckets)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                labelvalues: Iterable[Iterable[str]] = ((),)) -> Metric:
+        return self._declare('counter', name, documentation, labelnames, labelvalues)
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              labelvalues: Iterable[Iterable[str]] = ((),)) -> Metric:
+        return self._declare('gauge', name, documentation, labelnames, labelvalues)
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  labelvalues: Iterable[Iterable[str]] = ((),), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Metric:
+        return self._declare('histogram', name, documentation, labelnames, labelvalues, sorted(buckets))
+
+    def bind(self, prefix: str):
+        """将当前进程的指标迁移到共享文件中的一个空闲槽，所有指标声明完成后、开始处理请求前调用
+
+        :param prefix: 共享文件路径前缀，实际文件为 ``{prefix}.{布局哈希}.mmap``
+        """
+        if self._mm is not None:
+            return
+        size = len(self.values)
+        layout = '\n'.join(metric.layout for metric in self.metrics.values())
+        digest = hashlib.blake2b(layout.encode('utf-8'), digest_size=4).hexdigest()
+        self.path = f'{prefix}.{digest}.mmap'
+        # 每个槽的最后一个位置存放持有该槽的进程 pid
+        slot_bytes = (size + 1) * 8
+        fd = open_shared_file(self.path, slot_bytes * self.slots)
+        try:
+            self._mm = mmap.mmap(fd, slot_bytes * self.slots, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        for slot in range(self.slots):
+            lock = HostFileLock(f'{self.path}.{slot}.lock')
+            if lock.try_acquire():
+                break
+        else:
+            logger.warning(f'指标共享文件 {self.path} 没有空闲的槽，只输出当前进程的指标')
+            return
+        self._lock = lock
+        view = memoryview(self._mm)[slot * slot_bytes:(slot + 1) * slot_bytes].cast('d')
+        for metric in self.metrics.values():
+            for child in metric.children.values():
+                for i in range(child.index, child.index + metric.width):
+                    view[i] = self.values[i] + (view[i] if metric.kind != 'gauge' else 0)
+        view[size] = os.getpid()
+        self.values = view[:size]
+        logger.info(f'指标绑定到共享文件 {self.path} 的第 {slot} 个槽')
+
+    def close(self):
+        """释放当前进程的槽，之后的计数只记录在本地；槽中已有的计数保留，由下一个使用该槽的进程继续累加"""
+        if self._lock is None:
+            return
+        self.values = array('d', self.values)
+        self._lock.release()
+        self._lock = None
+
+    def _slots(self) -> Iterator[tuple[int, memoryview | array]]:
+        """返回 (pid, 指标值)，pid 为 0 表示该进程已经退出"""
+        size = len(self.values)
+        if self._lock is None:
+            yield os.getpid(), self.values
+        if self._mm is None:
+            return
+        slot_bytes = (size + 1) * 8
+        for slot in range(self.slots):
+            view = memoryview(self._mm)[slot * slot_bytes:(slot + 1) * slot_bytes].cast('d')
+            pid = int(view[size])
+            if pid:
+                yield (pid if _pid_alive(pid) else 0), view
+
+    def render(self) -> str:
+        """汇总所有 worker 的指标，输出 Prometheus 文本格式"""
+        size = len(self.values)
+        totals = [0.0] * size
+        live: list[tuple[int, memoryview | array]] = []
+        for pid, values in self._slots():
+            for i, value in enumerate(values[:size]):
+                totals[i] += value
+            if pid:
+                live.append((pid, values))
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for values, child in metric.children.items():
+                labels = list(zip(metric.labelnames, values))
+                if metric.kind == 'counter':
+                    lines.append(f'{metric.name}{_labels(labels)} {_number(totals[child.index])}')
+                elif metric.kind == 'gauge':
+                    for pid, slot_values in live:
+                        lines.append(f'{metric.name}{_labels([*labels, ("pid", str(pid))])} '
+                                     f'{_number(slot_values[child.index])}')
+                else:
+                    cumulative = 0.0
+                    for offset, bound in enumerate((*metric.buckets, math.inf)):
+                        cumulative += totals[child.index + offset]
+                        lines.append(f'{metric.name}_bucket{_labels([*labels, ("le", _number(bound))])} '
+                                     f'{_number(cumulative)}')
+                    lines.append(f'{metric.name}_sum{_labels(labels)} '
+                                 f'{_number(totals[child.index + metric.width - 1])}')
+                    lines.append(f'{metric.name}_count{_labels(labels)} {_number(cumulative)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _labels(labels: list[tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f'{{{pairs}}}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+# 所有模块共用的指标注册表，由 lifespan（--workers 模式下还有主进程）调用 bind
+metrics = MetricsRegistry()
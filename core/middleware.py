@@ -4,37 +4,198 @@
 # @时间       :2023/9/21 上午11:15
 # @作者       :lihb
 # @说明       : 中间件
-import time
 import uuid
+import zlib
 
+import anyio
 from fastapi import FastAPI
-from fastapi.middleware.gzip import GZipMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from fastapi.routing import APIRoute
+from loguru import logger
+from starlette.datastructures import MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
-
-from core.config import request_id_var, request_time_it_var
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from core.config import RequestTimer, request_id_var, request_time_it_var, settings
+from core.log import begin_tail_buffer, end_tail_buffer
+from core.metrics import Counter, Histogram, metrics
 
 # logger = logging.getLogger(__name__)
 
+REQUEST_ID_KEY = b'x-request-id'
+# 没有匹配到 APIRoute 的请求（404、文档页面等）统一记录在这个路由标签下，避免扫描请求产生大量时间序列
+OTHER_ROUTE = ('OTHER', 'other')
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+# (method, 路由模板) -> (耗时直方图, 各状态码类别的请求数)，由 instrument_routes 生成
+_route_metrics: dict[tuple[str, str], tuple[Histogram, dict[str, Counter]]] = {}
+
+
+def instrument_routes(app: FastAPI):
+    """为应用的每个路由声明请求耗时直方图和请求数，需要在添加完所有路由之后、启动 worker 之前调用
+
+    指标按路由模板（如 /api/items/{item_id}）而不是实际路径统计；流式响应的耗时为整个流结束的时间。
+    """
+    routes = [(method, route.path) for route in app.routes if isinstance(route, APIRoute)
+              for method in sorted(route.methods)]
+    routes.append(OTHER_ROUTE)
+    duration = metrics.histogram('http_request_duration_seconds', '请求耗时（秒），按路由模板统计',
+                                 ('method', 'route'), routes)
+    requests = metrics.counter('http_requests_total', '请求数，status 为状态码类别', ('method', 'route', 'status'),
+                               [(*route, status) for route in routes for status in STATUS_CLASSES])
+    for route in routes:
+        _route_metrics[route] = (duration.labels(*route),
+                                 {status: requests.labels(*route, status) for status in STATUS_CLASSES})
+
+
+def observe_request(scope: Scope, status_code: int, seconds: float):
+    """记录一次请求的耗时和状态码，只是对共享内存的几次加法，不加锁"""
+    route = scope.get('route')
+    series = _route_metrics.get((scope['method'], route.path) if route is not None else OTHER_ROUTE)
+    if series is None:
+        series = _route_metrics.get(OTHER_ROUTE)
+        if series is None:
+            return
+    duration, requests = series
+    duration.observe(seconds)
+    requests[STATUS_CLASSES[min(max(status_code // 100, 1), 5) - 1]].inc()
 
-class ContextMiddleware(BaseHTTPMiddleware):
 
-    async def dispatch(
-            self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        start_time = time.time()
+class ContextMiddleware:
+    """纯 ASGI 中间件，为请求设置链路ID、计时和配置快照
+
+    不经过 BaseHTTPMiddleware，没有额外的任务和内存流，流式响应也不会被缓冲。
+    响应头中带上 X-Request-Id 和 Server-Timing，请求结束时输出一条访问日志。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        # 请求开始时设置一次计时，请求过程中的每条日志都能带上当前耗时
+        timer = RequestTimer()
+        request_time_it_var.set(timer)
         # 为日志添加链路ID
-        REQUEST_ID_KEY = "X-Request-Id"
-        request_id = request.headers.get(REQUEST_ID_KEY, str(uuid.uuid4()))
+        request_id = next((value.decode('latin-1') for key, value in scope['headers'] if key == REQUEST_ID_KEY),
+                          None) or str(uuid.uuid4())
         request_id_var.set(request_id)
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        request_time_it_var.set(f'{process_time: .3f}')
+        # 固定本次请求使用的配置快照，请求处理过程中配置更新也不会读到一半新一半旧的配置
+        settings_token = settings.pin()
+        tail_token = begin_tail_buffer()
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = int(message['status'])
+                headers = MutableHeaders(scope=message)
+                headers.append('X-Request-Id', request_id)
+                headers.append('Server-Timing', f'app;dur={timer.elapsed * 1000:.1f}')
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            observe_request(scope, status_code, timer.stop())
+            end_tail_buffer(tail_token, flush=True)
+            logger.info(f'{scope["method"]} {scope["path"]} {status_code}')
+            raise
+        finally:
+            settings.unpin(settings_token)
+        process_time = timer.stop()
+        observe_request(scope, status_code, process_time)
+        # 请求失败或过慢时输出请求中缓存的 DEBUG 日志
+        end_tail_buffer(tail_token, flush=status_code >= 500 or process_time > settings.log.tail_slow_threshold)
+        # 访问日志
+        logger.info(f'{scope["method"]} {scope["path"]} {status_code}')
+
+
+class CompressionMiddleware:
+    """gzip 压缩中间件，配置读取 settings.compression，随nacos配置实时生效
+
+    - 客户端不支持 gzip、响应已经压缩过或 Content-Type 在 excluded_types 中时原样透传，SSE 不会被缓冲
+    - 单次发送且小于 minimum_size 的响应体不压缩
+    - 大于 offload_size 的响应体在线程池中压缩，不阻塞事件循环
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        compression = settings.compression
+        if scope['type'] != 'http' or not compression.enabled or not self._accept_gzip(scope):
+            await self.app(scope, receive, send)
+            return
+        await _GzipResponder(self.app, compression)(scope, receive, send)
+
+    @staticmethod
+    def _accept_gzip(scope: Scope) -> bool:
+        return any(key == b'accept-encoding' and b'gzip' in value for key, value in scope['headers'])
+
+
+class _GzipResponder:
+    def __init__(self, app: ASGIApp, compression):
+        self.app = app
+        self.compression = compression
+        self.send: Send | None = None
+        self.start_message: Message | None = None
+        # None 表示还没决定，True 压缩，False 透传
+        self.compress: bool | None = None
+        self.compressor = zlib.compressobj(compression.level, zlib.DEFLATED, 31)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_wrapper)
+
+    async def _compress(self, body: bytes, finish: bool) -> bytes:
+        if len(body) >= self.compression.offload_size:
+            return await anyio.to_thread.run_sync(self._compress_sync, body, finish)
+        return self._compress_sync(body, finish)
+
+    def _compress_sync(self, body: bytes, finish: bool) -> bytes:
+        data = self.compressor.compress(body)
+        return data + self.compressor.flush() if finish else data
+
+    async def send_wrapper(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            headers = MutableHeaders(raw=message['headers'])
+            content_type = headers.get('content-type', '')
+            if 'content-encoding' in headers or any(content_type.startswith(excluded)
+                                                    for excluded in self.compression.excluded_types):
+                self.compress = False
+                await self.send(message)
+            else:
+                # 等到第一段响应体再决定是否压缩
+                self.start_message = message
+            return
+        if message['type'] != 'http.response.body' or self.compress is False:
+            await self.send(message)
+            return
 
-        return response
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        headers = MutableHeaders(raw=self.start_message['headers'])
+        if self.compress is None:
+            if not more_body and len(body) < self.compression.minimum_size:
+                self.compress = False
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compress = True
+            headers['Content-Encoding'] = 'gzip'
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                body = await self._compress(body, finish=True)
+                headers['Content-Length'] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+            await self.send(self.start_message)
+        body = await self._compress(body, finish=not more_body)
+        await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
 
 
 def add_middleware(app: FastAPI):
@@ -46,4 +207,4 @@ def add_middleware(app: FastAPI):
             allow_methods=["*"],  # 一个允许跨域请求的 HTTP 方法列表
             allow_headers=["*"],  # 一个允许跨域请求的 HTTP 请求头列表
     )
-    app.add_middleware(GZipMiddleware, minimum_size=1000)
+    app.add_middleware(CompressionMiddleware)
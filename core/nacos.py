@@ -4,23 +4,29 @@
 # @时间       :2023/12/5 上午10:14
 # @作者       :lihb
 # @说明       : 进行读写配置和注册服务
+import asyncio
 import json
 import os
-import threading
+import tempfile
 import time
 from enum import Enum
-from functools import cached_property
+from functools import cached_property, lru_cache
+from pathlib import Path
+from urllib.parse import unquote
 
 import httpx
-import yaml
 from loguru import logger
-from pydantic import Field, HttpUrl, IPvAnyAddress
+from pydantic import BaseModel, Field, HttpUrl, IPvAnyAddress
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from core.access_token import NacosTokenManager
 from core.config import settings
+from core.discovery import NacosDiscovery
 from core.exceptions import AiChatException
-from core.log import setup_logging
-from utils.commonality import calculate_md5, get_host_ip
+from core.heartbeat import NacosHeartbeat, NacosInstance
+from core.metrics import metrics
+from core.settings import Settings
+from utils.commonality import HostFileLock, SharedEnumMmap, calculate_md5, deep_merge, get_host_ip, ssl_context
 
 
 class EnvEnum(str, Enum):
@@ -33,6 +39,15 @@ class EnvEnum(str, Enum):
 
 environment_name = "ENVIRONMENT_NACOS"
 
+# 长轮询在配置没有变化时由服务端挂起 30 秒，桶在 30 秒附近更密
+NACOS_LONG_POLL_SECONDS = metrics.histogram('nacos_long_poll_seconds', 'nacos配置长轮询的往返时间（秒）',
+                                            buckets=(0.1, 0.5, 1, 5, 10, 20, 29, 30, 30.5, 31, 35, 40))
+NACOS_LONG_POLL_FAILURES = metrics.counter('nacos_long_poll_failures_total', 'nacos配置长轮询失败次数')
+NACOS_CONFIG_RELOADS = metrics.counter('nacos_config_reloads_total', '配置重新加载次数，source 为配置来源',
+                                       ('source',), [('snapshot',), ('nacos',), ('shared',)])
+NACOS_CONFIG_VERSION = metrics.gauge('nacos_config_version', '当前配置快照的版本号，每次配置变化加1')
+NACOS_SHARED_CONFIG_VERSION = metrics.gauge('nacos_shared_config_version', '已发布或已应用的共享内存配置快照版本号')
+
 
 class Nacos(BaseSettings):
     app_name: str = Field(..., description='app名称')
@@ -44,27 +59,99 @@ class Nacos(BaseSettings):
     group: str = Field(..., description='nacos组')
     username: str = Field(..., description='nacos用户')
     password: str = Field(..., description='nacos组')
+    shared_dir: Path = Field(Path(tempfile.gettempdir()), description='同主机多个worker共享配置快照、选主锁文件的目录')
+    shared_size: int = Field(1024 * 1024, description='共享配置快照的最大字节数')
+    shared_configs: list[str] = Field([], description='共享配置，格式为 dataId 或 dataId:group，优先级最低')
+    extension_configs: list[str] = Field([], description='扩展配置，格式同 shared_configs，优先级高于共享配置、低于应用配置')
+    register_ports: list[int] = Field([], description='除 app_port 外需要注册到nacos的端口')
+    subscribe_services: list[str] = Field([], description='需要订阅的服务名称，用于服务发现')
+    snapshot_dir: Path = Field(settings.base_dir / '.nacos', description='本地配置快照目录，启动时先从快照加载配置')
+    register_instance: bool = Field(True, description='当前进程是否注册实例，--workers 模式下由主进程注册，worker 不注册')
+    drain_delay: float = Field(10, description='收到 SIGTERM 后先摘除实例，等待消费方实例缓存过期的时间（秒）')
+    drain_timeout: float = Field(30, description='停止接收请求后，等待处理中的请求完成的最长时间（秒）')
     model_config = SettingsConfigDict(env_prefix='nacos_')
 
 
-def get_nacos_settings():
-    from core.config import settings
-    environment = os.environ.get(environment_name)
-    nacos = Nacos(_env_file=f'{settings.base_dir_str}/.env.{environment}')
-    return nacos
+class NacosConfig(BaseModel):
+    data_id: str = Field(..., description='nacos的dataId')
+    group: str = Field(..., description='nacos组')
+    tenant: str = Field(..., description='nacos命名空间')
+    md5: str | None = Field(None, description='当前配置内容的MD5')
+    content: str = Field('', description='配置原文')
+    data: dict = Field({}, description='解析后的配置')
+
 
+def merge_configs(configs: list[NacosConfig]) -> dict:
+    """按优先级合并多个dataId的配置，最后一个为应用自身的配置
 
-class NacosHelper:
+    共享配置和扩展配置通常还包含其他服务的配置项（例如 spring、redis），只保留本应用 Settings 中定义的顶层配置项，
+    否则一个未知的配置项会导致整个配置更新失败；应用自身配置中的未知配置项仍然报错。
+    """
+    fields = Settings.model_fields
+    merged = {}
+    for config in configs[:-1]:
+        ignored = [key for key in config.data if key not in fields]
+        if ignored:
+            logger.info(f'忽略共享配置 {config.data_id} 中不属于本应用的配置项 {ignored}')
+        merged = deep_merge(merged, {key: value for key, value in config.data.items() if key in fields})
+    if configs:
+        merged = deep_merge(merged, configs[-1].data)
+    return merged
+
+
+def get_nacos_settings() -> Nacos:
+    """读取当前环境的nacos配置，同一个环境只读取一次 .env 文件"""
+    return _load_nacos_settings(os.environ.get(environment_name))
+
+
+@lru_cache(maxsize=None)
+def _load_nacos_settings(environment: str | None) -> Nacos:
+    return Nacos(_env_file=f'{settings.base_dir_str}/.env.{environment}')
+
+
+def load_yaml(text: str) -> dict:
+    """解析yaml配置，yaml 在第一次解析时才导入，不影响启动速度"""
+    import yaml
+
+    try:
+        return yaml.safe_load(text) or {}
+    except yaml.YAMLError as exc:
+        raise ValueError(f'yaml解析失败: {exc}') from exc
+
+
+class AsyncNacosHelper:
     def __init__(self):
-        self._cached_token = None
-        self._content_md5 = None
         self.settings = get_nacos_settings()
-        self._lock = threading.Lock()
+        self.configs = self._build_configs()
+        self._config_map = {(config.data_id, config.group, config.tenant): config for config in self.configs}
+        self._tasks: set[asyncio.Task] = set()
+        # 同一主机上只有一个 worker（leader）去长轮询nacos，解析后的配置通过共享内存发布给其他 worker
+        self.shared_prefix = self.settings.shared_dir / f'{self.settings.app_name}-{self.settings.app_port}'
+        shared_prefix = self.shared_prefix
+        self._leader = HostFileLock(f'{shared_prefix}.leader.lock')
+        self._shared_conf = SharedEnumMmap(self.settings.shared_size, path=f'{shared_prefix}.conf.mmap')
+        self._applied_version = 0
+        self.token_manager = NacosTokenManager(self, str(shared_prefix))
+        self.snapshot_file = (self.settings.snapshot_dir /
+                              f'{self.settings.namespace}-{self.settings.group}-{self.data_id}.json')
+        self.discovery = NacosDiscovery(self)
+        # 本服务需要注册的实例，app_port 之外还可以通过 register_ports 注册其他端口
+        self.instances = [
+            NacosInstance(ip=str(self.settings.app_ip), port=port, service_name=self.settings.app_name,
+                          group=self.settings.group, namespace=self.settings.namespace)
+            for port in dict.fromkeys([self.settings.app_port, *self.settings.register_ports])
+        ]
+        self.instance = self.instances[0]
+        self.heartbeat = NacosHeartbeat(self)
+        self.discovery.subscribe(*self.settings.subscribe_services)
         self.headers = {
             # 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36',
             'Content-Type': 'application/x-www-form-urlencoded',
         }
-        self.client = httpx.Client(base_url=str(self.settings.server_add), headers=self.headers, timeout=30)
+        # 长轮询、心跳、注册共用一个连接池，保持长连接
+        limits = httpx.Limits(max_connections=10, max_keepalive_connections=5)
+        self.client = httpx.AsyncClient(base_url=str(self.settings.server_add), headers=self.headers, timeout=30,
+                                        limits=limits, verify=ssl_context())
 
     @staticmethod
     def err_status(res: httpx.Response):
@@ -83,217 +170,421 @@ class NacosHelper:
             case _:
                 raise AiChatException(f'未知错误 status: {res.status_code}, text: {res.text}')
 
-    @property
-    def get_nacos_token(self):
+    async def get_nacos_token(self):
         """获取nacos token"""
-        if self._cached_token and self._cached_token.get('expiration_time', 0) > int(time.time()):
-            return self._cached_token.get('accessToken')  # 返回缓存的 token 数据
-        with self._lock:
-            if self._cached_token and self._cached_token.get('expiration_time', 0) > int(time.time()):
-                return self._cached_token.get('accessToken')
-            nacos_uri = f'/nacos/v1/auth/login'
-
-            data = {
-                'username': self.settings.username,
-                'password': self.settings.password
-            }
-            response = self.client.post(nacos_uri, data=data)
-            response.raise_for_status()
-            token_data = response.json()
-
-            token_info = {
-                'accessToken': token_data['accessToken'],
-                'tokenTtl': token_data['tokenTtl'],
-                'expiration_time': int(time.time() * 1000) + token_data['tokenTtl'] * 1000
-            }
-            logger.info(f'获取nacos的token: {token_info}')
-            # 缓存 token 数据
-            self._cached_token = token_info
-
-            return token_info['accessToken']
-
-    def load_conf(self):
-        """ 获取nacos配置
-
-        :return:
+        return await self.token_manager.get_token()
+
+    async def request(self, method: str, url: str, params: dict | None = None, **kwargs) -> httpx.Response:
+        """带上accessToken请求nacos，返回403时使用新的token重试一次"""
+        params = dict(params or {})
+        params['accessToken'] = token = await self.get_nacos_token()
+        res = await self.client.request(method, url, params=params, **kwargs)
+        if res.status_code == 403:
+            logger.warning(f'nacos返回403，刷新token后重试 {url}')
+            params['accessToken'] = await self.token_manager.refresh(stale=token)
+            res = await self.client.request(method, url, params=params, **kwargs)
+        return res
+
+    def _build_configs(self) -> list[NacosConfig]:
+        """按优先级从低到高排列需要监听的配置：共享配置 < 扩展配置 < 应用自身配置"""
+        configs = []
+        for item in [*self.settings.shared_configs, *self.settings.extension_configs]:
+            data_id, _, group = item.partition(':')
+            configs.append(NacosConfig(data_id=data_id, group=group or self.settings.group,
+                                       tenant=self.settings.namespace))
+        configs.append(NacosConfig(data_id=self.data_id, group=self.settings.group, tenant=self.settings.namespace))
+        return configs
+
+    async def fetch_conf(self, config: NacosConfig):
+        """ 获取单个dataId的nacos配置
+
+        :param config: 需要获取的配置
+        :return: 配置文本
         """
         url = f'/nacos/v1/cs/configs'
         params = {
-            'tenant': self.settings.namespace,
-            'accessToken': self.get_nacos_token,
-            'dataId': f'{self.settings.app_name}.{self.settings.file_extension}',
-            'group': self.settings.group
+            'tenant': config.tenant,
+            'dataId': config.data_id,
+            'group': config.group
         }
-        res = self.client.get(url, params=params)
+        res = await self.request('GET', url, params=params)
         try:
             self.err_status(res)
         except AiChatException as e:
             logger.exception(e)
             raise AiChatException(e.message)
         text = res.text
-        logger.info(f'获取nacos配置\n{text}')
-        self._content_md5 = calculate_md5(text)
-        settings.update_data(yaml.safe_load(text))
-        logger.info(f'重新加载setting配置 {settings.model_dump_json(indent=2)}')
+        logger.info(f'获取nacos配置 {config.data_id}\n{text}')
+        config.content = text
+        config.md5 = calculate_md5(text)
+        config.data = load_yaml(text)
         return text
 
-    def listener_conf(self):
-        """ 监听nacos配置是否改变
+    async def load_conf(self, configs: list[NacosConfig] | None = None):
+        """ 获取nacos配置，只重新获取有变化的dataId，再按优先级合并后更新到settings
+
+        :param configs: 有变化的配置，为空时获取全部配置
+        :return: dataId 与配置文本的对应关系
+        """
+        texts = {}
+        for config in configs or self.configs:
+            texts[config.data_id] = await self.fetch_conf(config)
+        self.apply_conf('nacos')
+        self.save_snapshot()
+        if self._leader.held:
+            self.publish_conf()
+        return texts
+
+    def apply_conf(self, source: str = 'nacos'):
+        """按优先级合并所有dataId的配置并更新到settings
+
+        :param source: 配置来源，snapshot（本地快照）、nacos 或 shared（共享内存），用于统计重新加载次数
+        """
+        changed = settings.update_data(merge_configs(self.configs))
+        NACOS_CONFIG_RELOADS.labels(source).inc()
+        NACOS_CONFIG_VERSION.set(settings.current.version)
+        logger.info(f'重新加载setting配置, 变化的配置项 {sorted(changed)}')
+        if changed:
+            logger.debug(f'当前setting配置 {settings.model_dump_json(indent=2)}')
 
-        :return: 如果配置无变化：会返回空串
+    @property
+    def data_id(self):
+        return f'{self.settings.app_name}.{self.settings.file_extension}'
+
+    def save_snapshot(self):
+        """将最近一次成功加载的配置和MD5写入本地快照文件，先写临时文件再替换，避免写一半
+
+        原文与MD5不一致的配置不写入，否则下次启动时长轮询会因为MD5相同一直使用旧的原文
+        """
+        snapshot = [config.model_dump(include={'data_id', 'group', 'tenant', 'md5', 'content'})
+                    for config in self.configs if config.md5 and calculate_md5(config.content) == config.md5]
+        try:
+            self.snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.snapshot_file.with_name(f'{self.snapshot_file.name}.{os.getpid()}.tmp')
+            tmp_file.write_text(json.dumps({'configs': snapshot}, ensure_ascii=False), encoding='utf-8')
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError as exc:
+            logger.warning(f'写入本地配置快照失败 {self.snapshot_file}: {exc}')
+
+    def load_snapshot(self):
+        """从本地快照文件加载配置，之后长轮询会带上快照的MD5，只有远端配置不同时才会重新拉取
+
+        :return: 是否从快照加载成功
+        """
+        try:
+            snapshot = json.loads(self.snapshot_file.read_text(encoding='utf-8'))
+            for item in snapshot['configs']:
+                config = self._config_map.get((item['data_id'], item['group'], item['tenant']))
+                if config:
+                    config.data = load_yaml(item['content'])
+                    config.content, config.md5 = item['content'], item['md5']
+            self.apply_conf('snapshot')
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning(f'本地配置快照不可用 {self.snapshot_file}: {exc}')
+            return False
+        logger.info(f'从本地快照加载配置 {self.snapshot_file}')
+        return True
+
+    def publish_conf(self):
+        """leader 将解析后的配置发布到共享内存，供同主机的其他 worker 使用
+
+        同时发布配置原文，follower 成为 leader 后写入的本地快照与MD5一致
+        """
+        snapshot = [config.model_dump(include={'data_id', 'group', 'tenant', 'md5', 'content', 'data'})
+                    for config in self.configs if config.md5]
+        blob = json.dumps({'configs': snapshot}, ensure_ascii=False).encode('utf-8')
+        self._applied_version = self._shared_conf.write_blob(blob)
+        NACOS_SHARED_CONFIG_VERSION.set(self._applied_version)
+        logger.info(f'发布配置快照到共享内存 version: {self._applied_version}')
+
+    def apply_shared_conf(self):
+        """follower 从共享内存读取 leader 发布的配置，版本有变化时更新到 settings，不产生网络请求
+
+        :return: 是否应用了新版本
+        """
+        if self._shared_conf.version == self._applied_version:
+            return False
+        version, blob = self._shared_conf.read_blob()
+        if version == self._applied_version or not blob:
+            return False
+        for item in json.loads(blob)['configs']:
+            config = self._config_map.get((item['data_id'], item['group'], item['tenant']))
+            if config:
+                config.md5, config.data = item['md5'], item['data']
+                # 旧版本的 leader 不发布原文，原文与MD5不一致时 save_snapshot 会跳过该配置
+                config.content = item.get('content', '')
+        self.apply_conf('shared')
+        self._applied_version = version
+        NACOS_SHARED_CONFIG_VERSION.set(version)
+        logger.info(f'从共享内存加载配置快照 version: {version}')
+        return True
+
+    async def listener_conf(self):
+        """ 监听nacos配置是否改变，所有dataId在同一个长轮询请求中监听
+
+        :return: 有变化的配置，无变化或请求失败时返回空列表
         """
         # 轮训等待时间也就是说，等待多长时间会检查一次 秒
         timeout = 30
         headers = {'Long-Pulling-Timeout': str(timeout * 1000)}
         headers.update(**self.headers)
         url = f'/nacos/v1/cs/configs/listener'
-        data = f"Listening-Configs={self.settings.app_name}.{self.settings.file_extension}%02{self.settings.group}%02{self._content_md5 if self._content_md5 else ''}%02{self.settings.namespace}%01"
+        listening = ''.join(f"{config.data_id}\x02{config.group}\x02{config.md5 or ''}\x02{config.tenant}\x01"
+                            for config in self.configs)
+        start = time.monotonic()
         try:
-            res = self.client.post(url, data=data, headers=headers, timeout=timeout + 10)
+            res = await self.request('POST', url, data={'Listening-Configs': listening}, headers=headers,
+                                     timeout=timeout + 10)
             self.err_status(res)
-            logger.trace(f'监听nacos配置是否改变, status: {res.status_code}, 内容{"有变化" if res.text else "未变化"}')
-            return res.text
         except (httpx.HTTPError, AiChatException) as exc:
+            NACOS_LONG_POLL_FAILURES.inc()
             logger.exception(exc)
-            time.sleep(18)
-            return False
-        # print(res.text, res.status_code)
-
-    def run_listener_config_thread(self):
-        """后台运行监听nacos配置实例"""
-        # 使用 threading.Thread 创建一个新线程，目标为 listener_conf 方法
-        listener_thread = threading.Thread(target=self.listener_thread_worker, name='listener-thread')
-        # 将新线程设置为守护线程，确保主程序退出时线程也会退出
-        listener_thread.daemon = True
-        # 启动新线程
-        listener_thread.start()
-        # 注册实例
-        self.add_instance()
-        # 使用 threading.Thread 创建一个新线程，目标为 put_instance 方法
-        instance_thread = threading.Thread(target=self.instance_beat_thread_worker, name='instance-beat-thread')
-        # 将新线程设置为守护线程，确保主程序退出时线程也会退出
-        instance_thread.daemon = True
-        # 启动新线程
-        instance_thread.start()
-
-    def listener_thread_worker(self):
-        """线程工作函数，用于运行 listener_conf 方法"""
-        while True:
-            config_text = self.listener_conf()
-            if config_text:
-                # 处理配置文本的逻辑，更新应用程序配置等
-                self.load_conf()
-                setup_logging()
-            # 可以选择在一段时间后再次运行 listener_conf 方法，或者根据需求进行其他逻辑
-
-    def instance_beat_thread_worker(self):
-        """线程工作函数，用于运行 put_instance 方法"""
+            await asyncio.sleep(18)
+            return []
+        NACOS_LONG_POLL_SECONDS.observe(time.monotonic() - start)
+        # 返回内容为 dataId%02group%02tenant%01 的列表
+        changed = []
+        for item in unquote(res.text).strip().split('\x01'):
+            if not item:
+                continue
+            data_id, group, *tenant = item.split('\x02')
+            config = self._config_map.get((data_id, group, tenant[0] if tenant else ''))
+            if config:
+                changed.append(config)
+        logger.trace(f'监听nacos配置是否改变, status: {res.status_code}, 有变化的配置{[c.data_id for c in changed]}')
+        return changed
+
+    async def start(self):
+        """启动监听配置、注册实例和心跳任务，由 lifespan 负责调用
+
+        启动时只读取本地快照，不等待nacos，配置的校验和注册都在后台任务中完成
+        """
+        self.load_snapshot()
+        self._spawn(self.token_manager.run, name='nacos-token')
+        self._spawn(self.config_task_worker, name='nacos-config')
+        if self.settings.register_instance:
+            self._spawn(self.instance_beat_task_worker, name='nacos-instance-beat')
+        self._spawn(self.discovery.refresh_task_worker, name='nacos-discovery')
+
+    async def start_register(self):
+        """只注册实例并发送心跳，--workers 模式下由主进程调用，配置和服务发现由各个 worker 负责"""
+        self._spawn(self.token_manager.run, name='nacos-token')
+        self._spawn(self.instance_beat_task_worker, name='nacos-instance-beat')
+
+    def _spawn(self, worker, name: str):
+        """以受监管的方式运行后台任务，任务异常退出后自动重启"""
+
+        async def supervise():
+            while True:
+                try:
+                    await worker()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    logger.exception(f'后台任务 {name} 异常退出，5秒后重启: {exc}')
+                    await asyncio.sleep(5)
+
+        task = asyncio.create_task(supervise(), name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def config_task_worker(self):
+        """任务工作函数，leader 运行 listener_conf 长轮询，follower 读取共享内存中的配置快照"""
         while True:
-            time.sleep(4)
-            self.put_instance()
-
-    def add_instance(self):
+            if self._leader.try_acquire():
+                changed = await self.listener_conf()
+                if changed:
+                    # 只重新获取有变化的dataId，更新应用程序配置等
+                    await self.load_conf(changed)
+            else:
+                # leader 退出后锁会被释放，下一轮由某个 follower 接管
+                self.apply_shared_conf()
+                await asyncio.sleep(1)
+
+    async def instance_beat_task_worker(self):
+        """任务工作函数，先注册所有实例，再由同一个循环为这些实例发送心跳"""
+        for instance in self.instances:
+            if instance.key not in self.heartbeat.instances:
+                await self.add_instance(instance)
+                self.heartbeat.add(instance)
+        await self.heartbeat.run()
+
+    async def add_instance(self, instance: NacosInstance | None = None):
         """注册一个实例到nacos。
 
+        :param instance: 需要注册的实例，默认为本服务
         :return: 返回是否注册成功
         """
+        instance = instance or self.instance
         url = '/nacos/v1/ns/instance'
         params = {
-            'accessToken': self.get_nacos_token,
-            'port': self.settings.app_port,
-            'ip': str(self.settings.app_ip),
-            'weight': 1.0,
-            'serviceName': self.settings.app_name,
-            'groupName': self.settings.group,
+            'port': instance.port,
+            'ip': instance.ip,
+            'weight': instance.weight,
+            'serviceName': instance.service_name,
+            'groupName': instance.group,
+            'clusterName': instance.cluster,
             'encoding': 'UTF-8',
-            'enabled': 'true',
+            'enabled': str(instance.enabled).lower(),
             'healthy': 'true',
-            'namespaceId': self.settings.namespace,
-            "metadata": json.dumps({"preserved.register.source": "SPRING_CLOUD"})
+            'namespaceId': instance.namespace,
+            "metadata": json.dumps(instance.metadata)
             # 'metadata': {"preserved.register.source": "SPRING_CLOUD"}
         }
-        res = self.client.post(url, params=params)
+        res = await self.request('POST', url, params=params)
         self.err_status(res)
-        logger.info(f'注册实例到nacos {res.text}')
+        logger.info(f'注册实例到nacos {instance.key} {res.text}')
         return True if res.text == 'ok' else False
 
-    def del_instance(self):
+    async def del_instance(self, instance: NacosInstance | None = None):
         """ 注销实例
 
+        :param instance: 需要注销的实例，默认为本服务
         :return:
         """
+        instance = instance or self.instance
         url = f'/nacos/v1/ns/instance'
         params = {
-            'accessToken': self.get_nacos_token,
-            'serviceName': self.settings.app_name,
-            'ip': str(self.settings.app_ip),
-            'port': self.settings.app_port,
-            'groupName': self.settings.group,
+            'serviceName': instance.service_name,
+            'ip': instance.ip,
+            'port': instance.port,
+            'groupName': instance.group,
+            'clusterName': instance.cluster,
             'enabled': 'false',
-            'namespaceId': self.settings.namespace,
+            'namespaceId': instance.namespace,
         }
-        res = self.client.delete(url, params=params)
+        res = await self.request('DELETE', url, params=params)
         self.err_status(res)
-        logger.info(f'从nacos注销实例 {res.text}')
+        logger.info(f'从nacos注销实例 {instance.key} {res.text}')
         return True if res.text == 'ok' else False
 
-    @cached_property
-    def get_instance(self):
+    async def drain(self):
+        """将已注册的实例权重设为 0 并禁用，消费方刷新实例列表后不再把请求发到本实例，心跳继续发送"""
+        url = '/nacos/v1/ns/instance'
+        for instance in self.heartbeat.instances.values():
+            # 心跳返回 20404 重新注册时同样使用摘除后的状态
+            instance.weight, instance.enabled = 0, False
+            params = {
+                'serviceName': instance.service_name,
+                'groupName': instance.group,
+                'ip': instance.ip,
+                'port': instance.port,
+                'clusterName': instance.cluster,
+                'namespaceId': instance.namespace,
+                'weight': instance.weight,
+                'enabled': 'false',
+                'ephemeral': 'true',
+                'metadata': json.dumps(instance.metadata),
+            }
+            try:
+                res = await self.request('PUT', url, params=params)
+                self.err_status(res)
+                logger.info(f'从nacos摘除实例 {instance.key} {res.text}')
+            except (httpx.HTTPError, AiChatException) as exc:
+                logger.warning(f'摘除实例 {instance.key} 失败: {exc}')
+
+    async def get_instance(self):
         """ 查询实例详情
 
         :return: 查询到的详情
         """
         url = '/nacos/v1/ns/instance'
         params = {
-            'accessToken': self.get_nacos_token,
             'serviceName': self.settings.app_name,
             'ip': str(self.settings.app_ip),
             'port': self.settings.app_port,
             'groupName': self.settings.group,
             'namespaceId': self.settings.namespace,
         }
-        res = self.client.get(url, params=params)
+        res = await self.request('GET', url, params=params)
         self.err_status(res)
         logger.debug(f'查询实例详情 {res.text}')
         return res.text
 
-    @cached_property
-    def _put_instance_params(self):
-        params = {
-            # 'accessToken': self.get_nacos_token,
-            'encoding': 'UTF-8',
-            'serviceName': f"{self.settings.group}@@{self.settings.app_name}",
-            'namespaceId': self.settings.namespace,
-            'app': 'unknown',
-            'beat': json.dumps({"cluster": "DEFAULT", "ip": str(self.settings.app_ip),
-                                "metadata": {"preserved.register.source": "SPRING_CLOUD"}, "period": 5000,
-                                "port": self.settings.app_port, "scheduled": False,
-                                "serviceName": f"{self.settings.group}@@{self.settings.app_name}", "stopped": False,
-                                "weight": 1.0})
-        }
-        return params
-
-    def put_instance(self):
+    async def put_instance(self):
         """发送实例的心跳
 
-        :return:
+        :return: 服务端是否允许轻量心跳
         """
-        url = f'/nacos/v1/ns/instance/beat'
-
+        await self.heartbeat.beat(self.instance)
+        return self.instance.light_beat
+
+    async def close(self):
+        """停止后台任务、注销实例并关闭连接池"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._leader.release()
+        self._shared_conf.close()
+        await self.discovery.close()
         try:
-            res = self.client.put(url, params=self._put_instance_params)
-            self.err_status(res)
-        except (httpx.HTTPError, AiChatException) as exc:
-            logger.exception(exc)
-            return False
-        res_json = res.json()
+            # 只注销当前进程注册过的实例
+            for instance in list(self.heartbeat.instances.values()):
+                await self.del_instance(instance)
+        finally:
+            self.token_manager.close()
+            await self.client.aclose()
 
-        logger.trace(f'发送实例心跳 {res_json}')
-        return res_json['lightBeatEnabled']
+
+class NacosHelper:
+    """AsyncNacosHelper 的同步包装，供脚本等没有事件循环的场景使用"""
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._helper = self._run(self._create_helper())
+        self.settings = self._helper.settings
+
+    @staticmethod
+    async def _create_helper():
+        # httpx.AsyncClient 需要在事件循环中创建
+        return AsyncNacosHelper()
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    err_status = staticmethod(AsyncNacosHelper.err_status)
+
+    @property
+    def get_nacos_token(self):
+        """获取nacos token"""
+        return self._run(self._helper.get_nacos_token())
+
+    def load_conf(self, configs: list[NacosConfig] | None = None):
+        """ 获取nacos配置"""
+        return self._run(self._helper.load_conf(configs))
+
+    def listener_conf(self):
+        """ 监听nacos配置是否改变"""
+        return self._run(self._helper.listener_conf())
+
+    def add_instance(self):
+        """注册一个实例到nacos"""
+        return self._run(self._helper.add_instance())
+
+    def del_instance(self):
+        """ 注销实例"""
+        return self._run(self._helper.del_instance())
+
+    @cached_property
+    def get_instance(self):
+        """ 查询实例详情"""
+        return self._run(self._helper.get_instance())
+
+    def put_instance(self):
+        """发送实例的心跳"""
+        return self._run(self._helper.put_instance())
 
     def close(self):
-        self.del_instance()
-        self.client.close()
+        try:
+            self._helper._shared_conf.close()
+            self._helper.token_manager.close()
+            self._run(self._helper.client.aclose())
+        finally:
+            self._loop.close()
 
 
 if __name__ == '__main__':
@@ -305,7 +596,7 @@ if __name__ == '__main__':
         while True:
             test = n.listener_conf()
             if test:
-                n.load_conf()
+                n.load_conf(test)
             # time.sleep(5)
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :qianfan.py
+# @时间       :2024/1/24 上午10:30
+# @作者       :lihb
+# @说明       : 百度千帆大模型客户端，应用生命周期内共享一个保持长连接的连接池
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+
+import anyio
+import httpx
+from fastapi import HTTPException
+from loguru import logger
+
+from core.config import settings
+from core.exceptions import AiChatException
+from core.metrics import metrics
+from core.quota import QuotaScheduler
+from models.qianfan import QianFanRequest
+from utils.cache import AsyncLRUCache, hash_key
+from utils.commonality import ssl_context
+
+# access_token 无效或过期的错误码
+TOKEN_ERROR_CODES = {110, 111}
+# 千帆限流的错误码：请求数、QPS、RPM、TPM 超限
+THROTTLE_ERROR_CODES = {4, 17, 18, 336501, 336502}
+
+QIANFAN_THROTTLED = metrics.counter('qianfan_throttled_total', '千帆返回限流错误的次数')
+QIANFAN_TOKENS = metrics.counter('qianfan_tokens_total', '千帆返回的 usage 中的 token 数', ('type',),
+                                 [('prompt',), ('completion',)])
+
+
+class QianFanClient:
+    """千帆对话接口客户端，由 lifespan 创建和关闭，接口中通过 request.app.state.qianfan 使用
+
+    连接池的大小在启动时确定，base_url、model、ak/sk 每次请求时读取当前配置，随nacos配置实时生效。
+    """
+
+    def __init__(self, quota_path: str | None = None):
+        """
+        :param quota_path: 共享配额令牌桶的文件路径前缀，同主机的 worker 共用，为空时只在当前进程内限速
+        """
+        conf = settings.qianfan
+        limits = httpx.Limits(max_connections=conf.max_connections,
+                              max_keepalive_connections=conf.max_keepalive_connections,
+                              keepalive_expiry=conf.keepalive_expiry)
+        timeout = httpx.Timeout(conf.read_timeout, connect=conf.connect_timeout)
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout, verify=ssl_context())
+        self._token: str | None = None
+        self._token_expire = 0.0
+        self._token_lock = asyncio.Lock()
+        # 上游配额调度，只有真正调用千帆的请求需要排队，缓存命中和合并的请求不消耗配额
+        self.quota = QuotaScheduler(quota_path)
+        cache_conf = self._cache_conf = settings.prompt_cache
+        # 相同提问的回答缓存，缓存的是千帆返回的原始 SSE 数据，命中时原样回放
+        self.cache = AsyncLRUCache(cache_conf.max_items, cache_conf.max_bytes, cache_conf.ttl)
+
+    async def get_token(self, stale: str | None = None) -> str:
+        """获取千帆的 access_token，过期前（有效期的 80%）重新获取
+
+        :param stale: 已失效的 token，当前 token 已经不是它时说明其他协程已经刷新过
+        """
+        if self._token and self._token != stale and self._token_expire > time.time():
+            return self._token
+        async with self._token_lock:
+            if self._token and self._token != stale and self._token_expire > time.time():
+                return self._token
+            conf = settings.qianfan
+            params = {'grant_type': 'client_credentials', 'client_id': conf.qianfan_ak,
+                      'client_secret': conf.qianfan_sk}
+            res = await self.client.post(f'{conf.base_url}/oauth/2.0/token', params=params)
+            res_json = res.json()
+            if 'access_token' not in res_json:
+                raise AiChatException(f'获取千帆access_token失败: {res_json.get("error_description", res.text)}')
+            self._token = res_json['access_token']
+            self._token_expire = time.time() + res_json.get('expires_in', 3600) * 0.8
+            logger.info(f'获取千帆的access_token, 有效期 {res_json.get("expires_in")} 秒')
+            return self._token
+
+    async def _open_stream(self, body: QianFanRequest, cost: int) -> httpx.Response:
+        conf = settings.qianfan
+        url = f'{conf.base_url}/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{conf.model}'
+        payload = {
+            'messages': [{'role': 'user', 'content': body.content}],
+            'system': body.system,
+            'stream': True,
+        }
+        if body.user_id is not None:
+            payload['user_id'] = str(body.user_id)
+        await self.quota.acquire(body.user_id, cost)
+        try:
+            return await self._send(url, payload)
+        except BaseException:
+            # 上游没有开始生成，退还预扣的 token 数
+            self.quota.settle(cost, 0)
+            raise
+
+    async def _send(self, url: str, payload: dict) -> httpx.Response:
+        """发送请求，access_token 失效时刷新后重试一次，千帆返回错误时抛出异常"""
+        token = None
+        for _ in range(2):
+            token = await self.get_token(stale=token)
+            request = self.client.build_request('POST', url, params={'access_token': token}, json=payload)
+            response = await self.client.send(request, stream=True)
+            if response.headers.get('content-type', '').startswith('text/event-stream'):
+                return response
+            # 出错时千帆返回普通的 JSON
+            await response.aread()
+            await response.aclose()
+            try:
+                error = response.json()
+            except ValueError:
+                error = {'error_msg': response.text}
+            if error.get('error_code') not in TOKEN_ERROR_CODES:
+                break
+        if error.get('error_code') in THROTTLE_ERROR_CODES:
+            QIANFAN_THROTTLED.inc()
+            logger.warning(f'千帆限流 {error.get("error_code")}: {error.get("error_msg")}')
+            raise HTTPException(status_code=429, detail='请求过多，请稍后重试', headers={'Retry-After': '1'})
+        raise AiChatException(f'千帆接口错误 {error.get("error_code")}: {error.get("error_msg")}')
+
+    @staticmethod
+    def stream_complete(chunks: list[bytes]) -> bool:
+        """SSE 数据中出现 is_end 为 true 的事件且没有 error_code 事件时才是完整的回答"""
+        ended = False
+        for line in b''.join(chunks).splitlines():
+            if not line.startswith(b'data:'):
+                continue
+            try:
+                event = json.loads(line[5:])
+            except ValueError:
+                return False
+            if not isinstance(event, dict) or event.get('error_code'):
+                return False
+            ended = ended or bool(event.get('is_end'))
+        return ended
+
+    @staticmethod
+    def cache_key(body: QianFanRequest) -> str:
+        """按模型和规范化后（去掉首尾空白、合并连续空白）的人设和提问生成缓存键，与 user_id 无关"""
+        return hash_key(settings.qianfan.model, ' '.join(body.system.split()), ' '.join(body.content.split()))
+
+    async def stream_chat(self, body: QianFanRequest) -> AsyncIterator[bytes]:
+        """发起流式对话，返回转发千帆 SSE 数据的异步迭代器
+
+        开启 prompt_cache 时相同的提问直接回放缓存，并发的相同提问共享一次上游请求。
+        上游返回错误时在开始响应之前抛出 AiChatException。
+        """
+        conf = settings.prompt_cache
+        if not conf.enabled:
+            return await self._stream_chat(body)
+        if conf != self._cache_conf:
+            self._cache_conf = conf
+            self.cache.configure(conf.max_items, conf.max_bytes, conf.ttl)
+        return await self.cache.stream(self.cache_key(body), lambda: self._stream_chat(body), self.stream_complete)
+
+    async def _stream_chat(self, body: QianFanRequest) -> AsyncIterator[bytes]:
+        """打开上游流，开始响应后所有读取方都断开时取消迭代，finally 中关闭上游连接，千帆不再继续生成"""
+        # 回答的长度事先不知道，先按提问的字数预扣 TPM，结束后按 usage 修正
+        reserved = len(body.content) + len(body.system or '')
+        try:
+            response = await self._open_stream(body, reserved)
+        except httpx.HTTPError as exc:
+            raise AiChatException(f'连接千帆失败: {exc!r}')
+
+        async def relay() -> AsyncIterator[bytes]:
+            usage = UsageParser()
+            try:
+                async for chunk in response.aiter_raw():
+                    usage.feed(chunk)
+                    yield chunk
+            except httpx.HTTPError as exc:
+                logger.warning(f'千帆流式响应中断: {exc!r}')
+                # 继续抛出，不完整的回答不能被当作正常结束写入缓存
+                raise
+            finally:
+                self.quota.settle(reserved, usage.total if usage.total is not None else reserved)
+                if usage.total is not None:
+                    QIANFAN_TOKENS.labels('prompt').inc(usage.prompt)
+                    QIANFAN_TOKENS.labels('completion').inc(usage.completion)
+                # 取消时也要关闭上游连接
+                with anyio.CancelScope(shield=True):
+                    await response.aclose()
+
+        return relay()
+
+    async def close(self):
+        await self.client.aclose()
+        self.quota.close()
+
+
+class UsageParser:
+    """从转发的 SSE 数据中找出千帆返回的 usage，只解析包含 usage 的行，数据块可能在行中间断开"""
+
+    def __init__(self):
+        self._pending = b''
+        self.prompt = 0
+        self.completion = 0
+        self.total: int | None = None
+
+    def feed(self, chunk: bytes):
+        *lines, self._pending = (self._pending + chunk).split(b'\n')
+        for line in lines:
+            if not line.startswith(b'data:') or b'"usage"' not in line:
+                continue
+            try:
+                usage = json.loads(line[5:]).get('usage') or {}
+            except (ValueError, AttributeError):
+                continue
+            self.prompt = usage.get('prompt_tokens', 0)
+            self.completion = usage.get('completion_tokens', 0)
+            self.total = usage.get('total_tokens', self.prompt + self.completion)
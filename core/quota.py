@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :quota.py
+# @时间       :2024/1/25 上午10:00
+# @作者       :lihb
+# @说明       : 上游大模型的配额调度，同主机共享的令牌桶限制 QPS 和 TPM，并按 user_id 公平排队
+import asyncio
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from typing import Hashable
+
+from fastapi import HTTPException
+
+from core.config import settings
+from core.metrics import metrics
+from utils.commonality import open_shared_file
+
+QUOTA_QUEUE_DEPTH = metrics.gauge('qianfan_quota_queue_depth', '等待千帆配额的请求数')
+QUOTA_QUEUED_USERS = metrics.gauge('qianfan_quota_queued_users', '有请求在等待千帆配额的用户数')
+QUOTA_GRANTED = metrics.counter('qianfan_quota_granted_total', '获得千帆配额的请求数')
+QUOTA_REJECTED = metrics.counter('qianfan_quota_rejected_total', '因配额不足返回 429 的请求数，reason 为拒绝原因',
+                                 ('reason',), [('queue_full',), ('expected_wait',), ('timeout',)])
+QUOTA_WAIT_SECONDS = metrics.histogram('qianfan_quota_wait_seconds', '排队等待千帆配额的时间（秒）',
+                                       buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+
+
+class TokenBucket:
+    """令牌桶，状态 ``(tokens, updated)`` 保存在文件映射中，同主机的所有 worker 共享同一个桶
+
+    每次读写都在 ``fcntl.lockf`` 的保护下完成，只在调用上游之前使用，不在每个请求的热路径上。
+    path 为空时使用临时文件，只在当前进程（及 fork 出来的子进程）内共享。
+    """
+    state = struct.Struct('<dd')
+
+    def __init__(self, path: str | os.PathLike | None = None):
+        self.path = path
+        self._fd = open_shared_file(path, self.state.size)
+        self.mm = mmap.mmap(self._fd, self.state.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _refill(self, rate: float, capacity: float, now: float) -> float:
+        tokens, updated = self.state.unpack_from(self.mm, 0)
+        # 新文件的 updated 为 0，第一次使用时令牌桶是满的
+        if not updated:
+            return capacity
+        return min(capacity, tokens + max(now - updated, 0) * rate)
+
+    def take(self, rate: float, capacity: float, cost: float = 1) -> float:
+        """令牌足够时扣除 cost 个令牌
+
+        :return: 0 表示已扣除，否则为还需要等待的秒数（不扣除）
+        """
+        # 超过桶容量的请求按装满一桶计算，否则永远等不到
+        need = min(cost, capacity)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            tokens = self._refill(rate, capacity, now)
+            wait = 0.0
+            if tokens >= need:
+                tokens -= cost
+            else:
+                wait = (need - tokens) / rate
+            self.state.pack_into(self.mm, 0, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return wait
+
+    def adjust(self, rate: float, capacity: float, amount: float):
+        """直接增减令牌，扣除后可以为负数，之后的请求需要等待补齐
+
+        先补充到当前时间再增减，否则下一次补充会从旧的时间开始并被 capacity 截断，修正的数量会丢失。
+        增加后最多为 capacity。
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            tokens = min(self._refill(rate, capacity, now) + amount, capacity)
+            self.state.pack_into(self.mm, 0, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def peek(self, rate: float, capacity: float) -> float:
+        """当前可用的令牌数，不加锁，只用于估算等待时间"""
+        return self._refill(rate, capacity, time.time())
+
+    def close(self):
+        self.mm.close()
+        os.close(self._fd)
+
+
+class QuotaScheduler:
+    """令牌桶限速的公平排队调度器
+
+    - 请求数令牌以 qps 的速度补充，最多积累 burst 个，每次上游调用消耗一个令牌
+    - tpm 大于 0 时另有一个按 tpm / 60 每秒补充的 token 数令牌桶，调用前按提问的长度预扣，
+      回答结束后按千帆返回的 usage 多退少补
+    - 两个令牌桶都通过文件映射在同主机的 worker 之间共享，--workers 模式下整机不超过配额
+    - 没有令牌时按用户排队，每个用户一个队列，轮流放行，单个用户的大量请求不会饿死其他用户
+    - 预计等待时间超过 max_wait 或排队总数超过 max_queue 时立即返回 429，不让客户端在超时后盲目重试
+
+    qps、burst、tpm 等参数每次调度时从 settings 读取，随nacos配置实时生效。
+    """
+
+    def __init__(self, path: str | None = None):
+        """
+        :param path: 共享令牌桶的文件路径前缀，为空时只在当前进程内限速
+        """
+        self.requests = TokenBucket(f'{path}.qps.bucket' if path else None)
+        self.tokens = TokenBucket(f'{path}.tpm.bucket' if path else None)
+        self._queues: OrderedDict[Hashable, deque[tuple[asyncio.Future, int]]] = OrderedDict()
+        self._queued = 0
+        self._dispatcher: asyncio.Task | None = None
+        self.granted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _take(self, cost: int) -> float:
+        """同时从两个令牌桶中扣除，返回 0 表示成功，否则为需要等待的秒数"""
+        conf = settings.current.qianfan
+        wait = self.requests.take(conf.qps, conf.burst)
+        if wait or not conf.tpm:
+            return wait
+        wait = self.tokens.take(conf.tpm / 60, conf.tpm, cost)
+        if wait:
+            # token 数不够时退还请求数令牌
+            self.requests.adjust(conf.qps, conf.burst, 1)
+        return wait
+
+    def _expected_wait(self, position: int, cost: int) -> float:
+        conf = settings.current.qianfan
+        wait = (position - self.requests.peek(conf.qps, conf.burst)) / conf.qps
+        if conf.tpm:
+            wait = max(wait, (cost - self.tokens.peek(conf.tpm / 60, conf.tpm)) * 60 / conf.tpm)
+        return wait
+
+    def _update_queued(self, delta: int):
+        self._queued += delta
+        QUOTA_QUEUE_DEPTH.set(self._queued)
+        QUOTA_QUEUED_USERS.set(len(self._queues))
+
+    def _reject(self, retry_after: float, reason: str):
+        self.rejected += 1
+        QUOTA_REJECTED.labels(reason).inc()
+        raise HTTPException(status_code=429, detail='请求过多，请稍后重试',
+                            headers={'Retry-After': str(max(math.ceil(retry_after), 1))})
+
+    def _grant(self, waited: float):
+        self.granted += 1
+        QUOTA_GRANTED.inc()
+        QUOTA_WAIT_SECONDS.observe(waited)
+
+    async def acquire(self, user: Hashable, cost: int = 1):
+        """获取一次上游调用的配额，需要排队时等待，无法在 max_wait 内获得时抛出 429
+
+        :param user: 排队使用的用户标识，匿名请求共用一个队列
+        :param cost: 预扣的 token 数，回答结束后通过 :meth:`settle` 按实际用量修正
+        """
+        if not self._queued and not self._take(cost):
+            self._grant(0)
+            return
+        conf = settings.current.qianfan
+        # 轮流放行时这个请求前面最多还有 (该用户排队数 + 1) * 排队用户数 个请求
+        queue = self._queues.get(user)
+        users = len(self._queues) + (queue is None)
+        position = min(self._queued + 1, (len(queue or ()) + 1) * users)
+        if self._queued >= conf.max_queue:
+            self._reject(self._expected_wait(position, cost), 'queue_full')
+        expected_wait = self._expected_wait(position, cost)
+        if expected_wait > conf.max_wait:
+            self._reject(expected_wait, 'expected_wait')
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[user] = deque()
+        queue.append((future, cost))
+        self._update_queued(1)
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, conf.max_wait)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._discard(user, future)
+            self._reject(conf.max_wait, 'timeout')
+        except BaseException:
+            self._discard(user, future)
+            raise
+        waited = time.monotonic() - start
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self._grant(waited)
+
+    def settle(self, reserved: int, used: int):
+        """回答结束后按实际使用的 token 数修正预扣的数量"""
+        conf = settings.current.qianfan
+        if conf.tpm and used != reserved:
+            self.tokens.adjust(conf.tpm / 60, conf.tpm, reserved - used)
+
+    def _discard(self, user: Hashable, future: asyncio.Future):
+        """取消排队，已经被调度器取出的不需要处理"""
+        queue = self._queues.get(user)
+        if queue is None:
+            return
+        for item in queue:
+            if item[0] is future:
+                queue.remove(item)
+                break
+        else:
+            return
+        if not queue:
+            del self._queues[user]
+        self._update_queued(-1)
+
+    async def _dispatch(self):
+        """有令牌时按用户轮流放行排队的请求，队列为空时退出"""
+        try:
+            while self._queued:
+                user, queue = next(iter(self._queues.items()))
+                future, cost = queue[0]
+                if not future.done():
+                    wait = self._take(cost)
+                    if wait:
+                        # 其他 worker 也在消耗同一个桶，等待后重新尝试
+                        await asyncio.sleep(wait)
+                        continue
+                queue.popleft()
+                if queue:
+                    self._queues.move_to_end(user)
+                else:
+                    del self._queues[user]
+                self._update_queued(-1)
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    def stats(self) -> dict:
+        conf = settings.current.qianfan
+        return {
+            'queued': self._queued,
+            'queued_users': len(self._queues),
+            'tokens': self.requests.peek(conf.qps, conf.burst),
+            'granted': self.granted,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'wait_avg': self.wait_total / self.granted if self.granted else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+    def close(self):
+        self.requests.close()
+        self.tokens.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :workers.py
+# @时间       :2024/1/30 上午10:20
+# @作者       :lihb
+# @说明       : 多 worker 进程管理和优雅退出：先从nacos摘除实例，等待消费方缓存过期，再停止接收请求，最后注销
+import asyncio
+import os
+import signal
+import uvicorn
+from loguru import logger
+from uvicorn._subprocess import get_subprocess
+
+from core.lifespan_handler import drain_callbacks
+from core.metrics import metrics
+from core.nacos import AsyncNacosHelper, get_nacos_settings
+
+
+class GracefulServer(uvicorn.Server):
+    """单进程模式使用的 uvicorn Server
+
+    收到 SIGTERM 时先执行 lifespan 注册的 drain_callbacks并等待 drain_delay 秒，期间继续处理请求，
+    之后才停止接收请求，由 uvicorn 在 timeout_graceful_shutdown 内等待处理中的请求完成，最后执行 lifespan 的退出。
+    再次收到信号或 SIGINT 时按 uvicorn 原来的方式处理。
+    """
+
+    def __init__(self, config: uvicorn.Config, drain_delay: float):
+        super().__init__(config)
+        self.drain_delay = drain_delay
+        self._draining = False
+
+    def handle_exit(self, sig: int, frame) -> None:
+        if sig != signal.SIGTERM or self._draining or not drain_callbacks:
+            super().handle_exit(sig, frame)
+            return
+        self._draining = True
+        asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            for callback in drain_callbacks:
+                await callback()
+            logger.info(f'等待 {self.drain_delay} 秒，消费方实例缓存过期后停止接收请求')
+            await asyncio.sleep(self.drain_delay)
+        except Exception as exc:
+            logger.exception(f'摘除实例失败: {exc}')
+        finally:
+            self.should_exit = True
+
+
+class WorkerManager:
+    """预先启动多个 worker 进程共享同一个监听 socket，主进程负责nacos注册和优雅退出
+
+    worker 通过环境变量 NACOS_REGISTER_INSTANCE=false 跳过实例注册，同一个 ip:port 只由主进程注册一次。
+    收到 SIGTERM 时：摘除实例（权重 0 并禁用）-> 等待 drain_delay -> 向 worker 发送 SIGTERM，
+    worker 在 drain_timeout 内处理完已有请求后退出 -> 注销实例。worker 异常退出时自动重启。
+    """
+
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.settings = get_nacos_settings()
+        self.processes = []
+        self.sockets = []
+        self._stop: asyncio.Event | None = None
+        self._drain = False
+
+    def run(self):
+        self.sockets = [self.config.bind_socket()]
+        os.environ['NACOS_REGISTER_INSTANCE'] = 'false'
+        for _ in range(self.workers):
+            self._start_worker()
+        logger.info(f'主进程 {os.getpid()} 已启动 {self.workers} 个 worker')
+        asyncio.run(self._supervise())
+
+    def _start_worker(self):
+        process = get_subprocess(self.config, target=uvicorn.Server(config=self.config).run, sockets=self.sockets)
+        process.start()
+        self.processes.append(process)
+
+    def _handle_signal(self, sig: signal.Signals):
+        # 只有 SIGTERM 需要先摘除实例，SIGINT（开发时 Ctrl+C）直接退出
+        self._drain = self._drain or sig == signal.SIGTERM
+        self._stop.set()
+
+    async def _supervise(self):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._handle_signal, sig)
+        helper = AsyncNacosHelper()
+        # 主进程的心跳和 token 指标与 worker 写入同一个文件，由 worker 的 /metrics 输出
+        metrics.bind(f'{helper.shared_prefix}.metrics')
+        await helper.start_register()
+        try:
+            while not self._stop.is_set():
+                for process in list(self.processes):
+                    if not process.is_alive():
+                        logger.warning(f'worker {process.pid} 异常退出（{process.exitcode}），重新启动')
+                        self.processes.remove(process)
+                        self._start_worker()
+                try:
+                    await asyncio.wait_for(self._stop.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+            if self._drain:
+                await helper.drain()
+                logger.info(f'等待 {self.settings.drain_delay} 秒，消费方实例缓存过期后停止 worker')
+                await asyncio.sleep(self.settings.drain_delay)
+            await self._stop_workers()
+        finally:
+            await helper.close()
+            metrics.close()
+            for sock in self.sockets:
+                sock.close()
+
+    async def _stop_workers(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        # worker 自己在 timeout_graceful_shutdown 内结束请求，这里多留几秒给 lifespan 退出
+        deadline = asyncio.get_running_loop().time() + self.settings.drain_timeout + 5
+        while any(p.is_alive() for p in self.processes) and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.1)
+        for process in self.processes:
+            if process.is_alive():
+                logger.warning(f'worker {process.pid} 未能在 {self.settings.drain_timeout} 秒内退出，强制结束')
+                process.kill()
+            process.join()
+        logger.info('所有 worker 已退出')
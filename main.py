@@ -1,40 +1,70 @@
+from __future__ import annotations
+
 import os
-from typing import Annotated
+import sys
+from typing import TYPE_CHECKING, Annotated
 
-import typer
 from fastapi import FastAPI
 
 # from typing_extensions import Literal
-from api import router
+from api import metrics_api, router
 from core.config import settings
 from core.exceptions import exception_handler
 from core.lifespan_handler import lifespan
-from core.middleware import add_middleware
+from core.middleware import add_middleware, instrument_routes
 from core.nacos import EnvEnum, environment_name, get_nacos_settings
+from utils.response import RResponse
+
+if TYPE_CHECKING:
+    import typer
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=RResponse)
 add_middleware(app)
 exception_handler(app)
 app.include_router(router=router)
+# Prometheus 指标不带 /api 前缀
+app.include_router(router=metrics_api.router)
+# 指标布局在导入时确定，--workers 模式下主进程和 worker 的布局一致才能共享同一个文件
+instrument_routes(app)
 
 
 def run(
         env: Annotated[EnvEnum, typer.Option(help='需要加载的环境')] = EnvEnum.local.value,
-        debug: Annotated[bool, typer.Option(help='是否需要开启debug模式，开启后会自动重载')] = False
+        debug: Annotated[bool, typer.Option(help='是否需要开启debug模式，开启后会自动重载')] = False,
+        workers: Annotated[int, typer.Option(help='worker 进程数，大于 1 时由主进程启动多个 worker 共享端口')] = 1
 
 ):
     os.environ[environment_name] = env.value
     import uvicorn
 
-    uvicorn.run(
-            "main:app",
-            reload=debug,
-            reload_excludes=['DirectoryV3.xml'],
-            app_dir=settings.base_dir_str,
-            host=str(get_nacos_settings().app_ip),
-            port=get_nacos_settings().app_port
+    nacos_settings = get_nacos_settings()
+    options = dict(
+            host=str(nacos_settings.app_ip),
+            port=nacos_settings.app_port,
+            # 访问日志由 ContextMiddleware 输出
+            access_log=False,
+            # 停止接收请求后等待处理中的请求完成的时间
+            timeout_graceful_shutdown=int(nacos_settings.drain_timeout),
     )
+    if debug:
+        uvicorn.run("main:app", reload=True, reload_excludes=['DirectoryV3.xml'], app_dir=settings.base_dir_str,
+                    **options)
+        return
+
+    from core.workers import GracefulServer, WorkerManager
+
+    # 与 uvicorn.run 的 app_dir 相同，worker 进程会继承 sys.path
+    sys.path.insert(0, settings.base_dir_str)
+
+    config = uvicorn.Config("main:app", workers=workers, **options)
+    if workers > 1:
+        WorkerManager(config, workers).run()
+    else:
+        GracefulServer(config, drain_delay=nacos_settings.drain_delay).run()
 
 
 if __name__ == '__main__':
+    # typer 只有命令行启动时需要，worker 导入 main:app 时不加载
+    import typer
+
     typer.run(run)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_cache.py
+# @时间       :2024/2/5 上午10:00
+# @作者       :lihb
+# @说明       : utils.cache 中相同请求合并的测试，python -m pytest tests
+import asyncio
+
+import pytest
+
+from utils.cache import AsyncLRUCache
+
+
+async def _source(*chunks: bytes):
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield chunk
+
+
+async def _read(stream) -> bytes:
+    return b''.join([chunk async for chunk in await stream])
+
+
+def test_stream_leader_cancelled_while_followers_wait():
+    """发起请求的调用方在上游打开前断开，等待中的请求不受影响，由其中一个重新打开上游"""
+
+    async def main():
+        cache = AsyncLRUCache()
+        calls = 0
+        first_opening = asyncio.Event()
+
+        async def opener():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                first_opening.set()
+                await asyncio.sleep(10)
+            return _source(b'a', b'b')
+
+        leader = asyncio.create_task(_read(cache.stream('k', opener)))
+        await first_opening.wait()
+        followers = [asyncio.create_task(_read(cache.stream('k', opener))) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await asyncio.gather(*followers) == [b'ab'] * 3
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # 只有一个等待者重新调用 opener，结果写入缓存
+        assert calls == 2
+        assert cache.get('k') == (b'a', b'b')
+
+    asyncio.run(main())
+
+
+def test_stream_opener_error_reaches_followers():
+    async def main():
+        cache = AsyncLRUCache()
+        opening = asyncio.Event()
+
+        async def opener():
+            opening.set()
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream down')
+
+        leader = asyncio.create_task(_read(cache.stream('k', opener)))
+        await opening.wait()
+        follower = asyncio.create_task(_read(cache.stream('k', opener)))
+        for task in (leader, follower):
+            with pytest.raises(ValueError):
+                await task
+        assert cache.stats()['inflight'] == 0
+
+    asyncio.run(main())
+
+
+def test_get_or_load_leader_cancelled_while_followers_wait():
+    async def main():
+        cache = AsyncLRUCache()
+        calls = 0
+        loading = asyncio.Event()
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            loading.set()
+            await asyncio.sleep(10 if calls == 1 else 0)
+            return b'value'
+
+        leader = asyncio.create_task(cache.get_or_load('k', loader))
+        await loading.wait()
+        followers = [asyncio.create_task(cache.get_or_load('k', loader)) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await asyncio.gather(*followers) == [b'value'] * 3
+        assert calls == 2
+
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_log_export.py
+# @时间       :2024/2/5 下午2:30
+# @作者       :lihb
+# @说明       : 日志推送的测试：攒批、gzip、重试、落盘和补发，python -m pytest tests
+import gzip
+import time
+
+import httpx
+from loguru import logger
+from starlette.testclient import TestClient
+
+from benchmarks.fake_log_collector import create_app
+from core import log
+from core.config import settings
+from core.log_export import HttpLogShipper
+
+
+def _shipper(tmp_path, handler, **kwargs) -> tuple[HttpLogShipper, list[bytes]]:
+    """返回推送器和收集服务收到的解压后的批次"""
+    received = []
+
+    def record(request: httpx.Request) -> httpx.Response:
+        response = handler(request)
+        if response.status_code < 300:
+            assert request.headers['content-encoding'] == 'gzip'
+            received.append(gzip.decompress(request.content))
+        return response
+
+    shipper = HttpLogShipper('http://collector/logs', tmp_path / 'spill', **kwargs)
+    shipper.client = httpx.Client(transport=httpx.MockTransport(record), headers=shipper.client.headers)
+    return shipper, received
+
+
+def test_batches_by_size_and_interval(tmp_path):
+    shipper, received = _shipper(tmp_path, lambda request: httpx.Response(200), batch_bytes=100, interval=60)
+    shipper.write('{"n": 1}\n')
+    shipper.flush()
+    # 没有达到 batch_bytes 也没有超过 interval，不发送
+    assert received == []
+    shipper.write('x' * 100 + '\n')
+    shipper.flush()
+    assert received == [b'{"n": 1}\n' + b'x' * 100 + b'\n']
+    shipper.write('{"n": 2}\n')
+    shipper.interval = 0
+    shipper.flush()
+    assert received[-1] == b'{"n": 2}\n'
+
+
+def test_retry_then_spill_and_resend(tmp_path, monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    statuses = iter([503, 200, 503, 503, 503, 200, 200])
+    shipper, received = _shipper(tmp_path, lambda request: httpx.Response(next(statuses)), retries=2)
+    # 第一次 503 后重试成功
+    shipper.write('a\n')
+    shipper.flush(force=True)
+    assert received == [b'a\n'] and shipper.sent == 1
+    # 重试用完后落盘
+    shipper.write('b\n')
+    shipper.flush(force=True)
+    assert shipper.failed == 1
+    assert len(shipper._spilled_files()) == 1
+    # 下一次发送成功后补发落盘的批次
+    shipper.write('c\n')
+    shipper.flush(force=True)
+    assert received == [b'a\n', b'c\n', b'b\n']
+    assert shipper._spilled_files() == []
+
+
+def test_client_error_is_not_retried(tmp_path):
+    calls = []
+    shipper, _ = _shipper(tmp_path, lambda request: calls.append(1) or httpx.Response(400), retries=3)
+    shipper.write('a\n')
+    shipper.flush(force=True)
+    assert len(calls) == 1 and len(shipper._spilled_files()) == 1
+
+
+def test_stop_spills_without_network(tmp_path):
+    shipper, received = _shipper(tmp_path, lambda request: httpx.Response(200))
+    shipper.write('a\n')
+    shipper.stop()
+    assert received == []
+    assert [gzip.decompress(file.read_bytes()) for file in shipper._spilled_files()] == [b'a\n']
+
+
+def test_tail_buffer_reaches_collector_in_text_format(tmp_path):
+    """标准输出为文本格式时，失败请求缓存的 DEBUG 日志同样以 JSON 行推送到收集服务"""
+    settings.update_data({'log_level': 'INFO', 'log': {
+        'format': 'text', 'tail_buffer': True, 'export_url': 'http://collector/logs', 'export_interval': 0,
+        'export_spill_dir': str(tmp_path / 'spill')}})
+    try:
+        log.setup_logging()
+        collector = create_app()
+        shipper = log._export_sink.stream
+        shipper.client = TestClient(collector, base_url='http://collector', headers=shipper.client.headers)
+        token = log.begin_tail_buffer()
+        logger.debug('tail context before failure')
+        log.end_tail_buffer(token, flush=True)
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            messages = [record['message'] for record in collector.state.records]
+            if 'tail context before failure' in messages:
+                break
+            time.sleep(0.05)
+        else:
+            raise AssertionError(f'收集服务没有收到缓存的日志: {collector.state.records}')
+        record = next(item for item in collector.state.records if item['message'] == 'tail context before failure')
+        assert record['level'] == 'DEBUG'
+    finally:
+        logger.remove()
+        settings.update_data({})
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_nacos.py
+# @时间       :2024/2/5 上午10:30
+# @作者       :lihb
+# @说明       : 多个dataId合并的测试，python -m pytest tests
+from contextvars import ContextVar
+
+import pytest
+
+from core.nacos import NacosConfig, merge_configs
+from core.settings import Settings, SettingsHolder
+
+
+def _config(data_id: str, data: dict) -> NacosConfig:
+    return NacosConfig(data_id=data_id, group='DEFAULT_GROUP', tenant='', data=data)
+
+
+def test_shared_config_with_foreign_keys():
+    """共享配置中其他服务的配置项被忽略，不影响应用自身配置的更新"""
+    holder = SettingsHolder(Settings(), ContextVar('settings', default=None))
+    configs = [
+        _config('common.yml', {'spring': {'datasource': {'url': 'jdbc:mysql://db'}}, 'redis': {'host': 'r'},
+                               'log_level': 'WARNING', 'qianfan': {'qps': 3}}),
+        _config('ext.yml', {'eureka': {'enabled': False}, 'qianfan': {'qps': 4, 'burst': 8}}),
+        _config('zw-ai-chat.yml', {'log_level': 'DEBUG'}),
+    ]
+    merged = merge_configs(configs)
+    assert 'spring' not in merged and 'redis' not in merged and 'eureka' not in merged
+    changed = holder.update_data(merged)
+    assert changed == {'log_level', 'qianfan'}
+    assert holder.current.log_level == 'DEBUG'
+    assert (holder.current.qianfan.qps, holder.current.qianfan.burst) == (4, 8)
+
+
+def test_unknown_key_in_app_config_is_rejected():
+    holder = SettingsHolder(Settings(), ContextVar('settings', default=None))
+    merged = merge_configs([_config('common.yml', {}), _config('zw-ai-chat.yml', {'typo_level': 'DEBUG'})])
+    with pytest.raises(ValueError):
+        holder.update_data(merged)
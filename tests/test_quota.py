@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_quota.py
+# @时间       :2024/2/5 下午3:30
+# @作者       :lihb
+# @说明       : 共享令牌桶的测试，python -m pytest tests
+import pytest
+
+from core import quota
+from core.quota import TokenBucket
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(quota, 'time', clock)
+    return clock
+
+
+def test_adjust_on_new_bucket_is_kept(clock):
+    """新文件的桶还没有更新时间，扣除的令牌不能在下一次补充时被装满的桶覆盖"""
+    bucket = TokenBucket()
+    bucket.adjust(1, 100, -50)
+    assert bucket.peek(1, 100) == 50
+    assert bucket.take(1, 100, 60) == pytest.approx(10)
+    bucket.close()
+
+
+def test_adjust_after_idle_refills_first(clock):
+    bucket = TokenBucket()
+    assert bucket.take(1, 100, 100) == 0
+    # 空闲 30 秒补充了 30 个令牌，修正在此基础上扣除
+    clock.now += 30
+    bucket.adjust(1, 100, -20)
+    assert bucket.peek(1, 100) == pytest.approx(10)
+    clock.now += 100
+    # 退还的令牌不超过容量
+    bucket.adjust(1, 100, 50)
+    assert bucket.peek(1, 100) == 100
+    bucket.close()
+
+
+def test_take_waits_for_missing_tokens(clock):
+    bucket = TokenBucket()
+    assert bucket.take(2, 4) == 0
+    bucket.take(2, 4, 3)
+    assert bucket.take(2, 4, 2) == pytest.approx(1)
+    bucket.close()
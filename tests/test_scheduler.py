@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_scheduler.py
+# @时间       :2024/2/5 上午11:00
+# @作者       :lihb
+# @说明       : JobRunner 的测试，python -m pytest tests
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+from utils import scheduler
+from utils.scheduler import TIMEZONE, CronExpr, JobRunner
+
+
+class _Clock:
+    """从下一个整分钟前 0.1 秒开始计时的时钟，cron 任务不需要真的等待一分钟"""
+
+    def __init__(self):
+        now = time.time()
+        self.offset = (now // 60 + 1) * 60 - 0.1 - now
+
+    def time(self) -> float:
+        return time.time() + self.offset
+
+    @staticmethod
+    def perf_counter() -> float:
+        return time.perf_counter()
+
+
+def test_cron_next_after():
+    cron = CronExpr('*/15 9-10 * * 1-5')
+    # 2024-02-02 是周五，下一次触发在下周一 9:00
+    dt = datetime(2024, 2, 2, 10, 50, tzinfo=TIMEZONE)
+    assert cron.next_after(dt) == datetime(2024, 2, 5, 9, 0, tzinfo=TIMEZONE)
+
+
+def test_cron_job_runs_at_minute_boundary(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(scheduler, 'time', clock)
+    runs = []
+
+    async def main():
+        runner = JobRunner()
+        runner.add_job(lambda: runs.append(clock.time()), cron='* * * * *', name='every_minute')
+        await runner.start()
+        await asyncio.sleep(0.5)
+        await runner.shutdown()
+        return runner.stats()['every_minute']
+
+    stats = asyncio.run(main())
+    assert stats['runs'] == 1 and stats['failures'] == 0
+    assert runs[0] % 60 < 0.5
+
+
+def test_per_host_job_runs_in_one_runner(tmp_path):
+    runs = {'a': 0, 'b': 0}
+
+    async def main():
+        runners = {name: JobRunner(lock_prefix=str(tmp_path / 'app')) for name in runs}
+        for name, runner in runners.items():
+            runner.add_job(lambda name=name: runs.__setitem__(name, runs[name] + 1), seconds=0.05,
+                           name='cleanup', per_host=True)
+            await runner.start()
+        await asyncio.sleep(0.4)
+        for runner in runners.values():
+            await runner.shutdown()
+        return {name: runner.stats()['cleanup'] for name, runner in runners.items()}
+
+    stats = asyncio.run(main())
+    # 先拿到锁的一个执行，另一个每次触发都跳过
+    assert sorted(runs.values())[0] == 0 and sorted(runs.values())[1] >= 3
+    assert sorted(job['skipped'] for job in stats.values())[1] >= 3
+
+
+def test_shutdown_does_not_block_event_loop():
+    """关闭时同步任务还在执行，事件循环中的其他协程照常运行"""
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_job():
+        started.set()
+        release.wait(5)
+
+    async def main():
+        runner = JobRunner()
+        runner.add_job(slow_job, seconds=0.01)
+        await runner.start()
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        shutdown = asyncio.create_task(runner.shutdown())
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not shutdown.done()
+        release.set()
+        await shutdown
+        return ticks
+
+    assert asyncio.run(main()) == 10
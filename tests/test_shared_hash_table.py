@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @文件       :test_shared_hash_table.py
+# @时间       :2024/2/5 下午4:30
+# @作者       :lihb
+# @说明       : SharedHashTable 读改写的测试，python -m pytest tests
+import multiprocessing
+
+from utils.commonality import SharedHashTable
+
+
+def _increment(value: bytes | None) -> tuple[bytes, int]:
+    count = int(value or b'0') + 1
+    return str(count).encode(), count
+
+
+def _worker(path: str, times: int):
+    table = SharedHashTable(buckets=16, ways=4, slot_size=64, path=path)
+    for _ in range(times):
+        table.update('counter', _increment)
+    table.close()
+
+
+def test_update_is_atomic_across_processes(tmp_path):
+    path = str(tmp_path / 'table.mmap')
+    table = SharedHashTable(buckets=16, ways=4, slot_size=64, path=path)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_worker, args=(path, 500)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert table.get('counter') == b'2000'
+    # 返回 None 时不写入
+    assert table.update('counter', lambda value: (None, value)) == b'2000'
+    assert table.update('missing', lambda value: (None, value)) is None
+    assert table.get('missing') is None
+    table.close()
+
+
+def test_update_items_keeps_expire(tmp_path):
+    table = SharedHashTable(buckets=16, ways=4, slot_size=64)
+    table.set('a', b'1', ttl=60)
+    table.set('b', b'2')
+    table.set('gone', b'3', ttl=-1)
+    seen = []
+
+    def double(value: bytes) -> bytes | None:
+        seen.append(value)
+        return None if value == b'2' else str(int(value) * 2).encode()
+
+    table.update_items(double)
+    assert sorted(seen) == [b'1', b'2']
+    assert (table.get('a'), table.get('b'), table.get('gone')) == (b'2', b'2', None)
+    table.close()
@@ -3,4 +3,252 @@
 # @文件       :cache.py
 # @时间       :2023/9/21 上午11:07
 # @作者       :lihb
-# @说明       :
+# @说明       : 进程内的异步 LRU 缓存，支持过期时间、内存上限和相同请求合并（single-flight）
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import pydantic_core
+from loguru import logger
+
+# 发起加载的调用方被取消时交给等待者的结果，等待者中的一个重新发起加载
+_ABANDONED = object()
+
+
+def hash_key(*parts: Any) -> str:
+    """把请求参数序列化后取 sha256 作为缓存键"""
+    return hashlib.sha256(pydantic_core.to_json(parts)).hexdigest()
+
+
+class _StreamFlight:
+    """正在进行中的一次上游流式请求，多个订阅者共享同一份数据
+
+    上游数据由独立的任务读取，单个订阅者断开不影响其他订阅者，所有订阅者都断开时取消上游请求。
+    """
+
+    def __init__(self):
+        # 结果为 True 表示上游已打开，False 表示发起请求的调用方在打开前被取消
+        self.opened: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.chunks: list[bytes] = []
+        self.size = 0
+        self.done = False
+        self.completed = False
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self, source: AsyncIterator[bytes], on_done: Callable[["_StreamFlight"], None],
+              complete: Callable[[list[bytes]], bool] | None = None):
+        self.opened.set_result(True)
+        self.task = asyncio.create_task(self._pump(source, on_done, complete))
+
+    def fail(self, exc: Exception):
+        self.opened.set_exception(exc)
+        # 没有等待者时避免 "exception was never retrieved" 警告
+        self.opened.exception()
+
+    def abandon(self):
+        """发起请求的调用方被取消，唤醒等待者，由其中一个重新打开上游"""
+        self.opened.set_result(False)
+
+    async def _pump(self, source: AsyncIterator[bytes], on_done: Callable[["_StreamFlight"], None],
+                    complete: Callable[[list[bytes]], bool] | None):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                self._notify()
+            # 上游正常结束但数据不完整（例如中途返回错误）时同样不写入缓存
+            self.completed = complete is None or complete(self.chunks)
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            logger.exception(f'读取上游流式数据失败: {exc}')
+        finally:
+            self.done = True
+            self._notify()
+            on_done(self)
+
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self.task.cancel()
+
+
+class AsyncLRUCache:
+    """进程内的异步 LRU 缓存
+
+    - 超过 max_items 条或 max_bytes 字节时淘汰最久未使用的条目，超过 ttl 秒的条目读取时视为不存在
+    - :meth:`get_or_load` 和 :meth:`stream` 对相同的键只发起一次上游请求，并发的请求等待同一个结果
+    - :meth:`stats` 返回命中、未命中、合并和淘汰次数
+    """
+
+    def __init__(self, max_items: int = 1024, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600,
+                 sizeof: Callable[[Any], int] = len):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._data: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self._bytes = 0
+        self._loading: dict[str, asyncio.Future] = {}
+        self._flights: dict[str, _StreamFlight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_items: int, max_bytes: int, ttl: float):
+        """配置变化时调整上限，超出部分立即淘汰"""
+        self.max_items, self.max_bytes, self.ttl = max_items, max_bytes, ttl
+        self._evict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str) -> Any | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expire, size, value = item
+        if expire <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int | None = None):
+        """写入缓存，size 为空时使用 sizeof(value) 计算占用的字节数"""
+        size = self.sizeof(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        self._evict()
+
+    def delete(self, key: str):
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.max_items or self._bytes > self.max_bytes):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """读取缓存，不存在时调用 loader 加载，相同键的并发调用共享同一次加载"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        while (future := self._loading.get(key)) is not None:
+            value = await asyncio.shield(future)
+            if value is not _ABANDONED:
+                self.coalesced += 1
+                return value
+        future = self._loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await loader()
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        except BaseException:
+            # 调用方被取消（例如客户端断开）不是加载失败，不能把 CancelledError 抛给仍在等待的请求
+            future.set_result(_ABANDONED)
+            raise
+        else:
+            future.set_result(value)
+            self.set(key, value)
+            return value
+        finally:
+            del self._loading[key]
+
+    async def stream(self, key: str, opener: Callable[[], Awaitable[AsyncIterator[bytes]]],
+                     complete: Callable[[list[bytes]], bool] | None = None) -> AsyncIterator[bytes]:
+        """缓存流式响应
+
+        命中时按原来的分段回放缓存的数据；相同键的请求正在进行时订阅同一个上游流；
+        否则调用 opener 打开上游流，完整读取成功后整体写入缓存。opener 抛出的异常会抛给所有等待者；
+        调用方在打开上游前被取消时，等待者中的一个重新调用 opener。
+        上游迭代器抛出异常时不写入缓存。
+
+        :param opener: 打开上游流的协程函数，返回逐段产生 bytes 的异步迭代器
+        :param complete: 判断读取到的数据是否完整，返回 False 时不写入缓存，为空时上游正常结束即视为完整
+        :return: 逐段产生 bytes 的异步迭代器
+        """
+        chunks = self.get(key)
+        if chunks is not None:
+            return self._replay(chunks)
+        while (flight := self._flights.get(key)) is not None:
+            if await asyncio.shield(flight.opened):
+                self.coalesced += 1
+                return flight.subscribe()
+        flight = self._flights[key] = _StreamFlight()
+        try:
+            source = await opener()
+        except Exception as exc:
+            del self._flights[key]
+            flight.fail(exc)
+            raise
+        except BaseException:
+            del self._flights[key]
+            flight.abandon()
+            raise
+        flight.start(source, lambda f: self._flight_done(key, f), complete)
+        return flight.subscribe()
+
+    def _flight_done(self, key: str, flight: _StreamFlight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight.completed:
+            self.set(key, tuple(flight.chunks), flight.size)
+
+    @staticmethod
+    async def _replay(chunks: tuple[bytes, ...]) -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+
+    def stats(self) -> dict:
+        return {
+            'items': len(self._data),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'inflight': len(self._loading) + len(self._flights),
+        }
@@ -4,12 +4,25 @@
 # @时间       :2023/12/5 下午2:37
 # @作者       :lihb
 # @说明       : 公共函数
+import fcntl
 import hashlib
+import math
 import mmap
+import os
 import socket
+import ssl
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, TypeVar
 
 from loguru import logger
 
+T = TypeVar('T')
+
 
 def calculate_md5(data):
     """ 计算data的MD5值
@@ -24,33 +37,168 @@ def calculate_md5(data):
     return md5
 
 
-def get_host_ip():
+def deep_merge(base: dict, override: dict) -> dict:
+    """ 递归合并两个字典，override 中的值优先，返回新字典
+
+    :param base: 低优先级的字典
+    :param override: 高优先级的字典
+    :return: 合并后的字典
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+@lru_cache(maxsize=None)
+def get_host_ip() -> str:
     """
-    查询本机ip地址
+    查询本机ip地址，结果会缓存
+
+    依次查找默认路由所在网卡、其他非回环网卡的 IPv4 地址，只读取本机网卡信息，离线时同样可用
     :return: ip
     """
-    s = None
+    for name in _interface_names():
+        ip = _interface_ip(name)
+        if ip and not ip.startswith('127.'):
+            return ip
+    # 没有 /proc 的系统：UDP 的 connect 只查询路由表，不会发出数据包
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+
+
+def _interface_names() -> list[str]:
+    """默认路由所在的网卡排在前面"""
+    names = []
+    try:
+        with open('/proc/net/route') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 1 and fields[1] == '00000000':
+                    names.append(fields[0])
+    except OSError:
+        pass
+    try:
+        names.extend(name for _, name in socket.if_nameindex())
+    except OSError:
+        pass
+    return list(dict.fromkeys(names))
+
+
+def _interface_ip(name: str) -> str | None:
+    """通过 SIOCGIFADDR 读取网卡的 IPv4 地址"""
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('8.8.8.8', 80))
-        ip = s.getsockname()[0]
-    finally:
-        if not s:
-            s.close()
-    return ip
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            packed = fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', name[:15].encode('utf-8')))
+    except OSError:
+        return None
+    return socket.inet_ntoa(packed[20:24])
+
+
+@lru_cache(maxsize=None)
+def ssl_context() -> ssl.SSLContext:
+    """所有 httpx 客户端共享的 SSL 上下文，加载 CA 证书需要几十毫秒，只加载一次"""
+    import httpx
+
+    return httpx.create_ssl_context()
+
+
+def open_shared_file(path: str | os.PathLike | None, size: int) -> int:
+    """打开（不存在时创建）用于共享内存映射的文件，文件小于 size 时扩展到 size
+
+    :param path: 文件路径，为空时创建一个已删除的临时文件，只能在 fork 出来的子进程间共享
+    :return: 文件描述符
+    """
+    if path is None:
+        with tempfile.TemporaryFile() as file:
+            fd = os.dup(file.fileno())
+    else:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    return fd
 
 
 class SharedEnumMmap:
-    def __init__(self, mmap_size=1024):
+    """带版本号的共享内存块。
+
+    头部为 ``(seq, length)`` 两个无符号64位整数，写入期间 seq 为奇数，写完后为偶数，
+    读取方按 seqlock 方式无锁读取，读到一致的数据为止。版本号为 ``seq // 2``。
+    传入 ``path`` 时使用文件映射，不同进程（包括 uvicorn 通过 spawn 启动的 worker）打开同一个文件即可共享；
+    否则使用匿名映射，只能在 fork 出来的子进程间共享。
+    写入方需要自行保证只有一个，一般配合 :class:`HostFileLock` 使用。
+    """
+    header = struct.Struct('<QQ')
+
+    def __init__(self, mmap_size=1024, path: str | os.PathLike | None = None):
         """
         初始化SharedEnumMmap对象，创建一个共享的mmap对象。
 
         Parameters:
-        - mmap_size (int): mmap的大小，默认为1024字节。
+        - mmap_size (int): 可存放数据的最大字节数，默认为1024字节。
+        - path (str): 映射的文件路径，为空时使用匿名映射。
         """
         self.mmap_size = mmap_size
-        # 创建共享的mmap对象，用于存储Enum的值
-        self.mm = mmap.mmap(-1, mmap_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.path = path
+        total_size = self.header.size + mmap_size
+        if path is None:
+            # 创建共享的mmap对象，用于存储Enum的值
+            self.mm = mmap.mmap(-1, total_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        else:
+            fd = open_shared_file(path, total_size)
+            try:
+                self.mm = mmap.mmap(fd, total_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+
+    @property
+    def version(self) -> int:
+        """当前已写入的版本号，0 表示还没有写入过数据"""
+        seq, _ = self.header.unpack_from(self.mm, 0)
+        return seq // 2
+
+    def write_blob(self, data: bytes) -> int:
+        """
+        写入一块数据，返回新的版本号。
+
+        Parameters:
+        - data (bytes): 要写入的数据，长度不能超过 mmap_size。
+        """
+        if len(data) > self.mmap_size:
+            raise ValueError(f'数据长度 {len(data)} 超过共享内存大小 {self.mmap_size}')
+        seq, _ = self.header.unpack_from(self.mm, 0)
+        seq += 1 if seq % 2 == 0 else 0
+        # seq 为奇数时表示正在写入，读取方会重试
+        self.header.pack_into(self.mm, 0, seq, 0)
+        self.mm[self.header.size:self.header.size + len(data)] = data
+        self.header.pack_into(self.mm, 0, seq + 1, len(data))
+        return (seq + 1) // 2
+
+    def read_blob(self, retries: int = 10000) -> tuple[int, bytes]:
+        """
+        无锁读取数据。
+
+        Parameters:
+        - retries (int): 与写入冲突时的最大重试次数，避免写入方中途退出时一直等待。
+
+        Returns:
+        - (版本号, 数据)
+        """
+        for _ in range(retries):
+            seq, length = self.header.unpack_from(self.mm, 0)
+            if seq % 2:
+                continue
+            data = self.mm[self.header.size:self.header.size + length]
+            if self.header.unpack_from(self.mm, 0)[0] == seq:
+                return seq // 2, data
+        raise BlockingIOError('共享内存一直处于写入状态')
 
     def write_enum_value(self, enum_value):
         """
@@ -60,10 +208,7 @@ class SharedEnumMmap:
         - enum_value: Enum对象，要写入的Enum值。
         """
         # 将Enum的值转换为字节串，并写入mmap
-        enum_str = enum_value.encode('utf-8')
-        self.mm.resize(len(enum_str))
-        self.mm.seek(0)
-        self.mm.write(enum_str)
+        self.write_blob(enum_value.encode('utf-8'))
 
     def read_enum_value(self):
         """
@@ -73,8 +218,7 @@ class SharedEnumMmap:
         - Enum: 读取的Enum值。
         """
         # 从mmap中读取字节串，并转换为Enum对象
-        self.mm.seek(0)
-        shared_enum_str = self.mm.read(len(self.mm))
+        _, shared_enum_str = self.read_blob()
         shared_enum_value = shared_enum_str.decode('utf-8')
         return shared_enum_value
 
@@ -83,3 +227,290 @@ class SharedEnumMmap:
         关闭mmap。
         """
         self.mm.close()
+
+
+class HostFileLock:
+    """基于 flock 的主机级别互斥锁，用于在同一台主机的多个 worker 中选出一个 leader。
+
+    持有锁的进程退出后，操作系统会自动释放锁，其他进程再次 :meth:`try_acquire` 即可接管。
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = path
+        self._fd: int | None = None
+
+    @property
+    def held(self) -> bool:
+        """当前进程是否持有锁"""
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """非阻塞地尝试获取锁
+
+        :return: 是否持有锁
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        """释放锁"""
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SharedHashTable:
+    """基于文件映射的定长哈希表，同一台主机上的所有 worker 共享同一份缓存。
+
+    内存布局为 64 字节的表头加 ``buckets * ways`` 个定长的槽，键按哈希值落到一个桶中，
+    只在桶内的 ways 个槽中查找（组相联），桶满时淘汰最早过期的条目。
+    每个槽以 seq 开头，与 :class:`SharedEnumMmap` 一样按 seqlock 方式无锁读取；
+    写入时用 ``fcntl.lockf`` 锁住所在桶的字节范围，不同桶的写入互不影响。
+    命中、未命中、淘汰等计数为当前进程的统计。
+    """
+    table_header = struct.Struct('<8sIII')
+    slot_header = struct.Struct('<QQdII')
+    magic = b'SHTABLE1'
+    header_size = 64
+
+    def __init__(self, buckets: int = 4096, ways: int = 8, slot_size: int = 512,
+                 path: str | os.PathLike | None = None):
+        """
+        Parameters:
+        - buckets (int): 桶的数量。
+        - ways (int): 每个桶中槽的数量。
+        - slot_size (int): 每个槽的字节数，键和值的总长度不能超过 ``slot_size - 32``。
+        - path (str): 映射的文件路径，为空时使用临时文件，只能在 fork 出来的子进程间共享。
+        """
+        if slot_size <= self.slot_header.size:
+            raise ValueError(f'slot_size 至少需要 {self.slot_header.size + 1} 字节')
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.bucket_size = ways * slot_size
+        self.path = path
+        total_size = self.header_size + buckets * self.bucket_size
+        self._fd = open_shared_file(path, total_size)
+        self.mm = mmap.mmap(self._fd, total_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        # lockf 的锁属于进程，同一进程内的多个线程另外用线程锁互斥
+        self._thread_lock = threading.Lock()
+        self._init_header()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _init_header(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.header_size, 0)
+        try:
+            magic, buckets, ways, slot_size = self.table_header.unpack_from(self.mm, 0)
+            if (magic, buckets, ways, slot_size) == (self.magic, self.buckets, self.ways, self.slot_size):
+                return
+            if magic == self.magic:
+                logger.warning(f'共享哈希表 {self.path} 的结构发生变化，清空后重新初始化')
+            self.mm[self.header_size:] = bytes(len(self.mm) - self.header_size)
+            self.table_header.pack_into(self.mm, 0, self.magic, self.buckets, self.ways, self.slot_size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.header_size, 0)
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        # 不能用内置的 hash()，不同进程的哈希种子不同；0 表示空槽
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+    def _bucket_offset(self, key_hash: int) -> int:
+        return self.header_size + key_hash % self.buckets * self.bucket_size
+
+    def _read_slot(self, offset: int, key_hash: int, retries: int = 100) -> tuple[float, int, bytes] | None:
+        """无锁读取一个槽，哈希值不同或一直处于写入状态时返回 None，否则返回 (过期时间, 键长度, 键和值)
+
+        作为缓存，读取方不等待写入方，重试 retries 次仍在写入时视为未命中。
+        """
+        for _ in range(retries):
+            seq, slot_hash, expire, key_len, value_len = self.slot_header.unpack_from(self.mm, offset)
+            if seq % 2:
+                continue
+            if slot_hash != key_hash:
+                return None
+            start = offset + self.slot_header.size
+            data = self.mm[start:start + key_len + value_len]
+            if self.slot_header.unpack_from(self.mm, offset)[0] == seq:
+                return expire, key_len, data
+        return None
+
+    def get(self, key: str) -> bytes | None:
+        """读取键对应的值，不存在或已过期时返回 None"""
+        key_bytes = key.encode('utf-8')
+        key_hash = self._hash(key_bytes)
+        offset = self._bucket_offset(key_hash)
+        for _ in range(self.ways):
+            slot = self._read_slot(offset, key_hash)
+            if slot is not None and slot[1] == len(key_bytes) and slot[2].startswith(key_bytes):
+                expire, _, data = slot
+                if expire <= time.time():
+                    self.expirations += 1
+                    break
+                self.hits += 1
+                return data[len(key_bytes):]
+            offset += self.slot_size
+        self.misses += 1
+        return None
+
+    def _write_slot(self, offset: int, key_hash: int, expire: float, key: bytes, value: bytes):
+        seq = self.slot_header.unpack_from(self.mm, offset)[0] | 1
+        # seq 为奇数时表示正在写入，读取方会重试
+        self.mm[offset:offset + 8] = seq.to_bytes(8, 'little')
+        start = offset + self.slot_header.size
+        self.mm[start:start + len(key) + len(value)] = key + value
+        self.slot_header.pack_into(self.mm, offset, seq, key_hash, expire, len(key), len(value))
+        self.mm[offset:offset + 8] = (seq + 1).to_bytes(8, 'little')
+
+    @contextmanager
+    def _locked(self, offset: int):
+        """锁住一个桶的字节范围"""
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.bucket_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bucket_size, offset)
+
+    def _find_slot(self, bucket: int, key_hash: int, key: bytes, now: float) -> tuple[int, bool]:
+        """在桶中查找写入键的槽，需要持有桶的锁
+
+        :return: (槽的位置, 是否为该键未过期的条目)，键不存在时依次选择空槽、已过期的槽、最早过期的槽
+        """
+        target, victim, victim_expire = None, None, math.inf
+        for offset in range(bucket, bucket + self.bucket_size, self.slot_size):
+            _, slot_hash, slot_expire, key_len, _ = self.slot_header.unpack_from(self.mm, offset)
+            start = offset + self.slot_header.size
+            if slot_hash == key_hash and self.mm[start:start + key_len] == key:
+                return offset, slot_expire > now
+            if target is None and (not slot_hash or slot_expire <= now):
+                target = offset
+            elif slot_expire < victim_expire or victim is None:
+                victim, victim_expire = offset, slot_expire
+        if target is None:
+            self.evictions += 1
+            return victim, False
+        return target, False
+
+    def _check_size(self, key: bytes, value: bytes):
+        if len(key) + len(value) > self.slot_size - self.slot_header.size:
+            raise ValueError(f'键值长度 {len(key) + len(value)} 超过槽的大小 '
+                             f'{self.slot_size - self.slot_header.size}')
+
+    def set(self, key: str, value: bytes, ttl: float | None = None):
+        """
+        写入键值，桶中没有空槽时淘汰最早过期的条目。
+
+        Parameters:
+        - key (str): 键。
+        - value (bytes): 值，键和值的总长度不能超过 ``slot_size - 32``。
+        - ttl (float): 有效期（秒），为空时不过期。
+        """
+        key_bytes = key.encode('utf-8')
+        self._check_size(key_bytes, value)
+        key_hash = self._hash(key_bytes)
+        bucket = self._bucket_offset(key_hash)
+        expire = math.inf if ttl is None else time.time() + ttl
+        with self._locked(bucket):
+            target, _ = self._find_slot(bucket, key_hash, key_bytes, time.time())
+            self._write_slot(target, key_hash, expire, key_bytes, value)
+        self.sets += 1
+
+    def update(self, key: str, func: Callable[[bytes | None], tuple[bytes | None, T]], ttl: float | None = None) -> T:
+        """
+        在桶的锁内读取键对应的值，再写入 func 返回的新值，多个 worker 可以用它共享计数。
+
+        Parameters:
+        - key (str): 键。
+        - func: 参数为当前的值（不存在或已过期时为 None），返回 (新值, 结果)，新值为 None 时不写入。
+          在锁内调用，不能再读写该表。
+        - ttl (float): 写入时的有效期（秒），为空时不过期。
+
+        Returns:
+        - func 返回的结果。
+        """
+        key_bytes = key.encode('utf-8')
+        key_hash = self._hash(key_bytes)
+        bucket = self._bucket_offset(key_hash)
+        with self._locked(bucket):
+            now = time.time()
+            target, found = self._find_slot(bucket, key_hash, key_bytes, now)
+            current = None
+            if found:
+                _, _, _, key_len, value_len = self.slot_header.unpack_from(self.mm, target)
+                start = target + self.slot_header.size + key_len
+                current = self.mm[start:start + value_len]
+            value, result = func(current)
+            if value is not None:
+                self._check_size(key_bytes, value)
+                self._write_slot(target, key_hash, math.inf if ttl is None else now + ttl, key_bytes, value)
+                self.sets += 1
+        return result
+
+    def update_items(self, func: Callable[[bytes], bytes | None]):
+        """对所有未过期的条目调用 func，返回值不为 None 时写回，过期时间不变
+
+        逐个桶加锁，没有条目的桶不加锁。func 在锁内调用，不能再读写该表。
+        """
+        for bucket in range(self.header_size, len(self.mm), self.bucket_size):
+            if not any(self.slot_header.unpack_from(self.mm, offset)[1]
+                       for offset in range(bucket, bucket + self.bucket_size, self.slot_size)):
+                continue
+            with self._locked(bucket):
+                now = time.time()
+                for offset in range(bucket, bucket + self.bucket_size, self.slot_size):
+                    _, slot_hash, expire, key_len, value_len = self.slot_header.unpack_from(self.mm, offset)
+                    if not slot_hash or expire <= now:
+                        continue
+                    start = offset + self.slot_header.size
+                    key = self.mm[start:start + key_len]
+                    value = func(self.mm[start + key_len:start + key_len + value_len])
+                    if value is not None:
+                        self._check_size(key, value)
+                        self._write_slot(offset, slot_hash, expire, key, value)
+
+    def delete(self, key: str) -> bool:
+        """删除键，返回键是否存在"""
+        key_bytes = key.encode('utf-8')
+        key_hash = self._hash(key_bytes)
+        bucket = self._bucket_offset(key_hash)
+        with self._locked(bucket):
+            for offset in range(bucket, bucket + self.bucket_size, self.slot_size):
+                _, slot_hash, _, key_len, _ = self.slot_header.unpack_from(self.mm, offset)
+                start = offset + self.slot_header.size
+                if slot_hash == key_hash and self.mm[start:start + key_len] == key_bytes:
+                    self._write_slot(offset, 0, 0.0, b'', b'')
+                    return True
+        return False
+
+    def stats(self) -> dict:
+        """当前进程的读写计数"""
+        return {
+            'capacity': self.buckets * self.ways,
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def close(self):
+        self.mm.close()
+        os.close(self._fd)
+
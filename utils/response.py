@@ -3,6 +3,31 @@
 # @文件       :response.py
 # @时间       :2023/9/21 上午11:07
 # @作者       :lihb
-# @说明       :
+# @说明       : 基于 pydantic-core 的 JSON 响应，直接序列化为 bytes
+from functools import lru_cache
+from typing import Any
 
+import pydantic_core
+from pydantic import BaseModel, TypeAdapter
+from starlette.responses import JSONResponse
 
+
+@lru_cache(maxsize=None)
+def type_adapter(tp: type) -> TypeAdapter:
+    """每个类型（包括 R[T] 这样的参数化泛型）只创建一次 TypeAdapter"""
+    return TypeAdapter(tp)
+
+
+class RResponse(JSONResponse):
+    """使用 pydantic-core 序列化的 JSON 响应，作为应用的默认响应类
+
+    - 内容是 R 等 pydantic 模型时按模型类型缓存的 TypeAdapter 直接输出 bytes，不经过 model_dump 和 json.dumps
+    - 其他内容（FastAPI 已经 jsonable_encoder 处理过的 dict/list）使用 pydantic_core.to_json 输出
+
+    接口直接返回 ``RResponse(R.success(data=...))`` 时还能跳过 FastAPI 的 jsonable_encoder。
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return type_adapter(type(content)).dump_json(content)
+        return pydantic_core.to_json(content)
@@ -3,14 +3,235 @@
 # @文件       :scheduler.py.py
 # @时间       :2023/12/5 下午4:57
 # @作者       :lihb
-# @说明       :
+# @说明       : 基于 asyncio 的轻量定时任务，由 lifespan 启动和关闭
 import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+from zoneinfo import ZoneInfo
 
-from apscheduler.executors.pool import ThreadPoolExecutor
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.schedulers.background import BackgroundScheduler
+from loguru import logger
 
-loop = asyncio.get_event_loop()
+from utils.commonality import HostFileLock
 
-ascheduler = AsyncIOScheduler(event_loop=loop, timezone='Asia/Shanghai')
-scheduler = BackgroundScheduler(executors={'threadpool': ThreadPoolExecutor()})
+TIMEZONE = ZoneInfo('Asia/Shanghai')
+
+
+class CronExpr:
+    """标准的 5 段 cron 表达式：分 时 日 月 周，支持 ``*``、``*/n``、``a-b``、``a-b/n`` 和逗号分隔的列表
+
+    周的取值为 0-6（0 为周日，7 也表示周日）。日和周都不是 ``*`` 时，满足其中一个即可，与 crontab 一致。
+    """
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f'cron 表达式 {expr!r} 需要 5 段')
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.ranges))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end:
+                raise ValueError(f'cron 字段 {field!r} 超出范围 {low}-{high}')
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        # datetime.weekday() 周一为 0，cron 周日为 0
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        """dt 之后的下一次触发时间"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 最多查找 4 年（闰年的 2 月 29 日）
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'cron 表达式 {self.expr!r} 没有可触发的时间')
+
+    def __str__(self):
+        return self.expr
+
+
+class Job:
+    """一个定时任务及其运行统计"""
+
+    def __init__(self, name: str, func: Callable, seconds: float | None, cron: CronExpr | None, jitter: float,
+                 lock: HostFileLock | None):
+        self.name = name
+        self.func = func
+        self.seconds = seconds
+        self.cron = cron
+        self.jitter = jitter
+        self.lock = lock
+        self.is_async = asyncio.iscoroutinefunction(func)
+        self.next_run: float | None = None
+        self.last_run: float | None = None
+        self.last_runtime = 0.0
+        self.total_runtime = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def next_after(self, timestamp: float) -> float:
+        if self.cron is not None:
+            return self.cron.next_after(datetime.fromtimestamp(timestamp, TIMEZONE)).timestamp()
+        return timestamp + self.seconds
+
+    def stats(self) -> dict:
+        return {
+            'trigger': str(self.cron) if self.cron is not None else f'every {self.seconds}s',
+            'runs': self.runs,
+            'failures': self.failures,
+            'coalesced': self.coalesced,
+            'skipped': self.skipped,
+            'last_run': self.last_run,
+            'next_run': self.next_run,
+            'last_runtime': self.last_runtime,
+            'avg_runtime': self.total_runtime / self.runs if self.runs else 0.0,
+        }
+
+
+class JobRunner:
+    """基于 asyncio 的定时任务调度器
+
+    - 支持固定间隔和 cron 两种触发方式，每次触发可以加随机抖动，避免多个 worker 同时执行
+    - 同一个任务不会并发执行，上一次执行超时或事件循环阻塞导致错过的多次触发合并为一次执行
+    - 同步函数在有上限的线程池中执行，不阻塞事件循环
+    - ``per_host=True`` 的任务通过文件锁在同一台主机的多个 worker 中只由一个执行
+    """
+
+    def __init__(self, max_workers: int = 4, lock_prefix: str | None = None):
+        """
+        :param max_workers: 执行同步任务的线程数
+        :param lock_prefix: per_host 任务的文件锁路径前缀，一般为 nacos 的 shared_dir/应用名-端口
+        """
+        self.lock_prefix = lock_prefix
+        self.jobs: dict[str, Job] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-runner')
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._started = False
+
+    def add_job(self, func: Callable[[], Awaitable | object], *, seconds: float | None = None,
+                cron: str | None = None, name: str | None = None, jitter: float = 0,
+                per_host: bool = False) -> Job:
+        """
+        添加定时任务，seconds 和 cron 二选一。
+
+        :param func: 任务函数，可以是协程函数或普通函数，没有参数
+        :param seconds: 执行间隔（秒）
+        :param cron: cron 表达式，按 Asia/Shanghai 时区触发
+        :param name: 任务名称，默认为函数名
+        :param jitter: 每次触发随机推迟 0 ~ jitter 秒
+        :param per_host: 同一台主机的多个 worker 中只由一个执行
+        """
+        if (seconds is None) == (cron is None):
+            raise ValueError('seconds 和 cron 需要且只能指定一个')
+        name = name or func.__name__
+        if name in self.jobs:
+            raise ValueError(f'任务 {name} 已存在')
+        lock = None
+        if per_host:
+            if self.lock_prefix is None:
+                raise ValueError('per_host 任务需要指定 lock_prefix')
+            lock = HostFileLock(f'{self.lock_prefix}.job.{name}.lock')
+        job = self.jobs[name] = Job(name, func, seconds, CronExpr(cron) if cron else None, jitter, lock)
+        if self._started:
+            self._tasks[name] = asyncio.create_task(self._run_job(job), name=f'job-{name}')
+        return job
+
+    def job(self, **kwargs):
+        """装饰器形式的 :meth:`add_job`"""
+
+        def decorator(func):
+            self.add_job(func, **kwargs)
+            return func
+
+        return decorator
+
+    async def start(self):
+        self._started = True
+        for name, job in self.jobs.items():
+            self._tasks[name] = asyncio.create_task(self._run_job(job), name=f'job-{name}')
+
+    async def _run_job(self, job: Job):
+        scheduled = job.next_after(time.time())
+        while True:
+            job.next_run = scheduled
+            await asyncio.sleep(max(scheduled - time.time(), 0) + random.uniform(0, job.jitter))
+            # 合并错过的触发，只执行一次
+            now = time.time()
+            following = job.next_after(scheduled)
+            while following <= now:
+                job.coalesced += 1
+                scheduled, following = following, job.next_after(following)
+            if job.lock is not None and not job.lock.try_acquire():
+                job.skipped += 1
+            else:
+                await self._execute(job)
+            scheduled = following
+
+    async def _execute(self, job: Job):
+        start = time.perf_counter()
+        job.last_run = time.time()
+        try:
+            if job.is_async:
+                await job.func()
+            else:
+                await asyncio.get_running_loop().run_in_executor(self._executor, job.func)
+        except Exception as exc:
+            job.failures += 1
+            logger.exception(f'定时任务 {job.name} 执行失败: {exc}')
+        finally:
+            job.last_runtime = time.perf_counter() - start
+            job.total_runtime += job.last_runtime
+            job.runs += 1
+
+    def stats(self) -> dict[str, dict]:
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    async def shutdown(self, wait: bool = True):
+        """取消所有任务，wait 为 True 时等待正在执行的同步任务结束
+
+        在线程中等待线程池关闭，执行时间很长的同步任务不会阻塞事件循环中的其他关闭步骤。
+        """
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+        self._started = False
+        await asyncio.to_thread(self._executor.shutdown, wait=wait, cancel_futures=True)
+        # 同步任务结束后再释放锁，其他 worker 接管后不会与仍在执行的任务重叠
+        for job in self.jobs.values():
+            if job.lock is not None:
+                job.lock.release()